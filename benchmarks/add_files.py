@@ -0,0 +1,56 @@
+"""Benchmark of adding a large number of files.
+
+A synthetic deep tree of file names is added to a :class:`tinyshar.SharCreator`
+(no file is read or created), then the leaf directories which are created by
+the archive epilogue are enumerated. Both steps are timed, along with the
+peak RSS of the process.
+
+Usage: python benchmarks/add_files.py [--files N] [--fanout N] [--depth N]
+"""
+import argparse
+import resource
+import time
+import tinyshar
+
+
+def names(files, fanout, depth):
+    """Yield `files` names spread over a tree of directories of `fanout`
+    subdirectories each, files being placed at all depths up to `depth`.
+    """
+    for i in range(files):
+        components = []
+        n = i
+        for _ in range(i % (depth + 1)):
+            components.append("d%02d" % (n % fanout))
+            n //= fanout
+
+        components.append("f%07d" % i)
+        yield '/'.join(components)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--files", type=int, default=1000000, help="number of files")
+    parser.add_argument("--fanout", type=int, default=10, help="number of subdirectories of each directory")
+    parser.add_argument("--depth", type=int, default=12, help="maximal depth of the tree")
+    args = parser.parse_args()
+
+    shar = tinyshar.SharCreator()
+
+    start = time.perf_counter()
+    for name in names(args.files, args.fanout, args.depth):
+        shar.add_file(name, b'')
+    add_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    leaf_dirs = sum(1 for _ in shar._tree.leaf_dirs())
+    leaf_dirs_seconds = time.perf_counter() - start
+
+    print("add_file   %8.3fs  (%.1f us/file)" % (add_seconds, add_seconds * 1e6 / max(args.files, 1)))
+    print("leaf_dirs  %8.3fs  (%d directories)" % (leaf_dirs_seconds, leaf_dirs))
+    # note: kilobytes on Linux, but bytes on macOS
+    print("peak rss   %10d" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Micro-benchmark of reader function serving compressor output.
+
+Compares the current implementation (deque of memoryviews) with the former
+list based one, which copied every served slice and popped chunks from
+the head of a list. Input chunks are served with read sizes typical for
+:class:`tinyshar.Base64Encoder` and :class:`tinyshar.RawEncoder`.
+
+Usage: python benchmarks/chunks_reader.py [--size-mb N] [--chunk-kb N]
+"""
+import argparse
+import time
+import tinyshar
+
+
+def legacy_chunks_reader(chunks):
+    chunks = iter(chunks)
+    compressed = []
+    compressed_pos = 0
+    eof = False
+
+    def reader_wrapper(n):
+        nonlocal compressed_pos
+        nonlocal eof
+
+        result = []
+
+        while n:
+            while n and compressed:
+                avail = min(n, len(compressed[0]) - compressed_pos)
+                if avail == 0:
+                    compressed.pop(0)
+                    compressed_pos = 0
+                    continue
+
+                result.append(compressed[0][compressed_pos:compressed_pos + avail])
+                n -= avail
+                compressed_pos += avail
+
+            if eof:
+                break
+
+            if n:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    eof = True
+                else:
+                    compressed.append(chunk)
+
+        return b''.join(result)
+
+    return reader_wrapper
+
+
+def measure(make_reader, size, chunk_size, read_size):
+    chunk = b'x' * chunk_size
+    reader = make_reader(chunk for _ in range(size // chunk_size))
+
+    start = time.perf_counter()
+    total = 0
+    while True:
+        data = reader(read_size)
+        if not data:
+            break
+        total += len(data)
+    elapsed = time.perf_counter() - start
+
+    assert total == size // chunk_size * chunk_size
+    return total / elapsed / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--size-mb", type=int, default=2048)
+    parser.add_argument("--chunk-kb", type=int, default=1024)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    chunk_size = args.chunk_kb * 1024
+
+    print("%-10s %12s %12s" % ("read size", "legacy MB/s", "current MB/s"))
+    for read_size in [57, 57 * 1024, 1024 * 1024]:
+        # legacy implementation is too slow to be run on full size with tiny reads
+        run_size = size if read_size > 57 else min(size, 64 * 1024 * 1024)
+        legacy = measure(legacy_chunks_reader, run_size, chunk_size, read_size)
+        current = measure(tinyshar._make_chunks_reader, run_size, chunk_size, read_size)
+        print("%-10d %12.1f %12.1f" % (read_size, legacy, current))
+
+
+if __name__ == "__main__":
+    main()
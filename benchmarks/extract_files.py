@@ -0,0 +1,103 @@
+"""Benchmark of extraction of archives of many small files.
+
+An archive of a synthetic tree of small files (a part of which are extracted
+to absolute paths) is rendered with each of the extraction modes, then
+extracted. Times of rendering and extraction, and the size of the script
+are reported.
+
+Usage: python benchmarks/extract_files.py [--files N] [--dirs N] [--absolute-percent N]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tinyshar
+
+
+MODES = {
+    'default': dict(),
+    'batch_moves': dict(batch_moves=True),
+    'in_place': dict(extract_in_place=True),
+    'in_place+batch_moves': dict(extract_in_place=True, batch_moves=True),
+    'default+trace_user': dict(trace='user'),
+    'solid': dict(solid=True),
+    'solid+batch_moves': dict(solid=True, batch_moves=True),
+}
+
+
+def make_shar(files, dirs, absolute_percent, target_dir):
+    shar = tinyshar.SharCreator()
+
+    for i in range(files):
+        name = "d%04d/f%07d" % (i % dirs, i)
+        if i % 100 < absolute_percent:
+            name = os.path.join(target_dir, name)
+
+        shar.add_file(name, b"%d\n" % i)
+
+    return shar
+
+
+def extract(script_path, tmp_dir):
+    os.chmod(script_path, 0o700)
+    env = dict(os.environ, TMPDIR=tmp_dir)
+
+    start = time.perf_counter()
+    subprocess.run(
+        [script_path],
+        env=env,
+        check=True,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--files", type=int, default=100000, help="number of files")
+    parser.add_argument("--dirs", type=int, default=100, help="number of directories")
+    parser.add_argument("--absolute-percent", type=int, default=10, help="percentage of files with absolute paths")
+    parser.add_argument("--mode", action='append', choices=sorted(MODES), help="extraction mode(s) to benchmark")
+    args = parser.parse_args()
+
+    print("%-22s %10s %10s %14s" % ("mode", "render s", "extract s", "script size"))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        target_dir = os.path.join(workdir, "target")
+        shar = make_shar(args.files, args.dirs, args.absolute_percent, target_dir)
+
+        for mode in args.mode or list(MODES):
+            script_path = os.path.join(workdir, "script.sh")
+            tmp_dir = os.path.join(workdir, "tmp")
+            os.makedirs(tmp_dir)
+
+            start = time.perf_counter()
+            with open(script_path, 'wb') as out_stm:
+                shar.render(
+                    out_stm=out_stm,
+                    encoder=tinyshar.RawEncoder(),
+                    build_validators=[],
+                    tee_to_file=False,
+                    **MODES[mode]
+                )
+            render_seconds = time.perf_counter() - start
+
+            extract_seconds = extract(script_path, tmp_dir)
+            print("%-22s %10.3f %10.3f %14d" % (
+                mode,
+                render_seconds,
+                extract_seconds,
+                os.path.getsize(script_path)
+            ))
+
+            os.unlink(script_path)
+            shutil.rmtree(tmp_dir)
+            shutil.rmtree(target_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Benchmark of archive rendering and extraction.
+
+Synthetic trees of different shapes are generated once, then for each
+combination of tree and encoder an archive is rendered in a separate process
+(so that peak RSS can be measured in isolation) and then extracted.
+Results are written as JSON, to be compared between releases.
+
+Usage: python benchmarks/render.py [-o results.json] [--scale X] [--tree NAME ...] [--encoder NAME ...]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tinyshar
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _text(rnd, size):
+    """Compressible, but not trivially, data."""
+    words = [b'alpha', b'beta', b'gamma', b'delta', b'epsilon', b'zeta', b'eta', b'theta']
+    block = b' '.join(rnd.choice(words) for _ in range(min(size, 64 * 1024) // 4 + 1))
+    return (block * (size // len(block) + 1))[:size]
+
+
+def tree_tiny(path, scale, rnd):
+    for i in range(int(10000 * scale)):
+        _write(os.path.join(path, "d%03d" % (i % 100), "f%05d" % i), _text(rnd, 100))
+
+
+def tree_huge(path, scale, rnd):
+    for i in range(3):
+        _write(os.path.join(path, "huge%d" % i), _text(rnd, int(64 * 1024 * 1024 * scale)))
+
+
+def tree_incompressible(path, scale, rnd):
+    for i in range(20):
+        _write(os.path.join(path, "random%02d" % i), os.urandom(int(4 * 1024 * 1024 * scale)))
+
+
+def tree_deep(path, scale, rnd):
+    for i in range(int(1000 * scale)):
+        components = ["level%02d" % j for j in range(i % 30)]
+        _write(os.path.join(path, *components, "f%04d" % i), _text(rnd, 1000))
+
+
+TREES = {
+    'tiny': tree_tiny,
+    'huge': tree_huge,
+    'incompressible': tree_incompressible,
+    'deep': tree_deep,
+}
+
+ENCODERS = {
+    'base64': lambda: tinyshar.Base64Encoder(),
+    'base64-xz': lambda: tinyshar.Base64Encoder(compressor=tinyshar.XzCompressor()),
+    'base64-gzip': lambda: tinyshar.Base64Encoder(compressor=tinyshar.GzipCompressor()),
+    'raw': lambda: tinyshar.RawEncoder(),
+    'raw-xz': lambda: tinyshar.RawEncoder(compressor=tinyshar.XzCompressor()),
+    'raw-gzip': lambda: tinyshar.RawEncoder(compressor=tinyshar.GzipCompressor()),
+}
+
+
+def render_one(tree_dir, encoder_name, script_path, shellcheck):
+    """Render a single archive. Run in a child process, prints results as JSON."""
+    shar = tinyshar.SharCreator()
+    shar.add_dir(tree_dir, '')
+
+    start = time.perf_counter()
+    with open(script_path, 'wb') as out_stm:
+        shar.render(
+            out_stm=out_stm,
+            encoder=ENCODERS[encoder_name](),
+            build_validators=None if shellcheck else [],
+        )
+    render_seconds = time.perf_counter() - start
+
+    json.dump(dict(
+        render_seconds=render_seconds,
+        # note: kilobytes on Linux, but bytes on macOS
+        peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        output_size=os.path.getsize(script_path),
+    ), sys.stdout)
+
+
+def extract(script_path, tmp_dir):
+    os.chmod(script_path, 0o700)
+    env = dict(os.environ, TMPDIR=tmp_dir)
+
+    start = time.perf_counter()
+    subprocess.run(
+        [script_path],
+        env=env,
+        check=True,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '_render':
+        render_one(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5] == '1')
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("-o", metavar="<file>", help="write JSON results to <file> instead of stdout")
+    parser.add_argument("--scale", type=float, default=1.0, help="scale factor for number and size of files")
+    parser.add_argument("--tree", action='append', choices=sorted(TREES), help="tree shape(s) to benchmark")
+    parser.add_argument("--encoder", action='append', choices=sorted(ENCODERS), help="encoder(s) to benchmark")
+    parser.add_argument("--workdir", help="directory for generated trees and archives. Defaults to a temporary one")
+    parser.add_argument("--no-extract", action='store_true', help="do not measure extraction")
+    parser.add_argument("--shellcheck", action='store_true', help="include shellcheck validation in render time")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        results = []
+
+        for tree_name in args.tree or sorted(TREES):
+            tree_dir = os.path.join(workdir, "trees", tree_name)
+            TREES[tree_name](tree_dir, args.scale, random.Random(tree_name))
+
+            for encoder_name in args.encoder or sorted(ENCODERS):
+                script_path = os.path.join(workdir, "script.sh")
+                cp = subprocess.run(
+                    [sys.executable, __file__, '_render', tree_dir, encoder_name, script_path,
+                     '1' if args.shellcheck else '0'],
+                    check=True,
+                    stdout=subprocess.PIPE,
+                )
+                result = dict(tree=tree_name, encoder=encoder_name, **json.loads(cp.stdout))
+
+                if not args.no_extract:
+                    tmp_dir = os.path.join(workdir, "tmp")
+                    os.makedirs(tmp_dir, exist_ok=True)
+                    result['extract_seconds'] = extract(script_path, tmp_dir)
+
+                os.unlink(script_path)
+                results.append(result)
+                print(
+                    "%-16s %-12s render %8.3fs  rss %10d  size %12d  extract %s" % (
+                        tree_name,
+                        encoder_name,
+                        result['render_seconds'],
+                        result['peak_rss'],
+                        result['output_size'],
+                        "%.3fs" % result['extract_seconds'] if 'extract_seconds' in result else '-',
+                    ),
+                    file=sys.stderr
+                )
+
+    report = dict(
+        tinyshar_version=tinyshar.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        scale=args.scale,
+        results=results,
+    )
+
+    if args.o:
+        os.makedirs(os.path.dirname(os.path.abspath(args.o)), exist_ok=True)
+        with open(args.o, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Benchmark of extraction-time verifiers.
+
+For each verifier, measures hashing throughput during render (i.e. of the
+reader wrapper installed by the verifier) and during extraction (i.e. of
+the ``<tool> -c`` invocation emitted into the script). Verifiers whose
+Python package or command line tool is not available are reported as such.
+
+Usage: python benchmarks/verifiers.py [--size-mb N] [--files N]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tinyshar
+
+
+VERIFIERS = {
+    'md5': tinyshar.Md5Verifier,
+    'sha256': tinyshar.Sha256Verifier,
+    'blake2': tinyshar.Blake2Verifier,
+    'xxhash': tinyshar.XxhashVerifier,
+}
+
+
+def measure_render(verifier, data, files):
+    data = memoryview(data)
+    start = time.perf_counter()
+
+    for i in range(files):
+        pos = 0
+        # the same read size as used by Base64Encoder
+        reader = verifier.wrap_reader(lambda n: data[pos:pos + n], b'%06d' % i)
+
+        while True:
+            chunk = reader(57 * 1024)
+            if not chunk:
+                break
+            pos += len(chunk)
+
+    return time.perf_counter() - start
+
+
+def measure_extract(verifier, data, files, tmp_dir):
+    for i in range(files):
+        with open(os.path.join(tmp_dir, '%06d' % i), 'wb') as f:
+            f.write(data)
+
+    # the here-document emitted by verifier.render
+    script = []
+    verifier.render(script.append)
+    here_doc = b''.join(script[1:-1])
+
+    start = time.perf_counter()
+    subprocess.run(
+        [verifier._tool.decode(), '-c', '--quiet'],
+        input=here_doc,
+        cwd=tmp_dir,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--size-mb", type=int, default=256, help="size of each file")
+    parser.add_argument("--files", type=int, default=4, help="number of files")
+    args = parser.parse_args()
+
+    data = os.urandom(args.size_mb * 1024 * 1024)
+    total_mb = args.size_mb * args.files
+
+    print("%-10s %14s %14s" % ("verifier", "render MB/s", "extract MB/s"))
+    for name, cls in VERIFIERS.items():
+        try:
+            verifier = cls()
+        except ImportError:
+            print("%-10s %14s %14s" % (name, "no package", "-"))
+            continue
+
+        render = total_mb / measure_render(verifier, data, args.files)
+
+        if shutil.which(verifier._tool.decode()):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                extract = "%.1f" % (total_mb / measure_extract(verifier, data, args.files, tmp_dir))
+        else:
+            extract = "no tool"
+
+        print("%-10s %14.1f %14s" % (name, render, extract))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,7 @@ setup(
     setup_requires=["setuptools_scm"],
     use_scm_version=True,
     python_requires=">=3.6, <4",
+    extras_require={"zstd": ["zstandard"], "xxhash": ["xxhash"]},
     packages=find_packages(where="src"),
     package_dir={"": "src"},
     entry_points={"console_scripts": ["tinyshar = tinyshar._cli:main"]},
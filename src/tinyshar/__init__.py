@@ -1,14 +1,25 @@
 import binascii as _binascii
 import collections as _collections
+import concurrent.futures as _futures
 import contextlib as _contextlib
 import hashlib as _hashlib
+import heapq as _heapq
 import io as _io
+import itertools as _itertools
 import lzma as _lzma
+import mmap as _mmap
 import os as _os
 import posixpath as _posixpath
+import queue as _queue
 import shlex as _shlex
 import shutil as _shutil
+import stat as _stat
 import subprocess as _subprocess
+import tarfile as _tarfile
+import tempfile as _tempfile
+import threading as _threading
+import time as _time
+import zlib as _zlib
 
 
 try:
@@ -38,6 +49,11 @@ def _to_bytes(s, what):
         return s
 
 
+def _quote(s):
+    """Quote bytes for shell. Unlike :func:`shlex.quote`, always uses single quotes."""
+    return b"'%s'" % s.replace(b"'", b"'\"'\"'")
+
+
 def _checked_which(what):
     result = _shutil.which(what)
     if result is None:
@@ -60,7 +76,104 @@ def _make_reader_stm(what):
     raise TypeError("don't know how to read %s" % type(what))
 
 
+def _fileno(stm):
+    """Return file descriptor of `stm`, or `None` if it is not backed by one."""
+    try:
+        return stm.fileno()
+    except (AttributeError, OSError, _io.UnsupportedOperation):
+        return None
+
+
+# setting up a mapping costs more than buffered reading of small files
+_MMAP_MIN_SIZE = 1024 * 1024
+
+
+def _file_fileno(stm):
+    """Return file descriptor of `stm` if it is a plain (optionally buffered) file, `None` otherwise.
+
+    Note: file objects transforming data (e.g. :class:`gzip.GzipFile`) also report
+    the descriptor of the underlying file, which must not be written to directly.
+    """
+    if isinstance(stm, (_io.BufferedWriter, _io.BufferedRandom)):
+        stm = stm.raw
+
+    if not isinstance(stm, _io.FileIO):
+        return None
+
+    return stm.fileno()
+
+
+def _mmap_stm(stm):
+    """Return a read-only memory map of `stm` if it is a regular file of at least `_MMAP_MIN_SIZE` bytes,
+    `None` otherwise.
+    """
+    fileno = _fileno(stm)
+    if fileno is None:
+        return None
+
+    st = _os.fstat(fileno)
+    if not _stat.S_ISREG(st.st_mode) or st.st_size == 0 or st.st_size < _MMAP_MIN_SIZE:
+        return None
+
+    return _mmap.mmap(fileno, 0, access=_mmap.ACCESS_READ)
+
+
+@_contextlib.contextmanager
+def _open_source(what, mmap=False):
+    """Yield a reader of file content (see :func:`SharCreator.add_file`).
+    If `mmap` is set, large regular files are memory mapped and read as zero-copy memoryview slices.
+
+    The `rewind` attribute of the reader is a function restarting reading from
+    the initial position, or `None` if the source is not seekable.
+    """
+    with _make_reader_stm(what) as stm:
+        mapped = _mmap_stm(stm) if mmap else None
+
+        if mapped is None:
+            def reader(n):
+                return stm.read(n)
+
+            if stm.seekable():
+                start = stm.tell()
+                reader.rewind = lambda: stm.seek(start)
+            else:
+                reader.rewind = None
+
+            yield reader
+            return
+
+        view = memoryview(mapped)
+        start = pos = stm.tell()
+
+        def reader(n):
+            nonlocal pos
+            chunk = view[pos:pos + n]
+            pos += len(chunk)
+            return chunk
+
+        def rewind():
+            nonlocal pos
+            pos = start
+
+        reader.rewind = rewind
+
+        try:
+            yield reader
+        finally:
+            view.release()
+
+            # slices still referenced by someone keep the map alive until they are collected
+            with _contextlib.suppress(BufferError):
+                mapped.close()
+
+
 class _NoCompressor:
+    def cache_key(self):
+        return b'none'
+
+    def close(self):
+        pass
+
     def wrap(self, reader):
         return b'', reader
 
@@ -72,47 +185,172 @@ Note: the signature of this class is not a part of a public API, only the class
 """
 
 
+def _drain(reader, chunk_size=1024 * 1024):
+    """Read `reader` till EOF, discarding data."""
+    while reader(chunk_size):
+        pass
+
+
+def _make_chunks_reader(chunks):
+    """Convert an iterable of bytes-like chunks into a reader function.
+
+    Requests served from a single chunk return a :class:`memoryview` slice
+    of it without copying.
+    """
+    chunks = iter(chunks)
+    buffered = _collections.deque()
+    buffered_size = 0
+
+    def reader(n):
+        nonlocal buffered_size
+
+        while buffered_size < n:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+
+            if chunk:
+                buffered.append(memoryview(chunk))
+                buffered_size += len(chunk)
+
+        if not buffered:
+            return b''
+
+        head = buffered[0]
+        if len(head) >= n:
+            if len(head) == n:
+                buffered.popleft()
+            else:
+                buffered[0] = head[n:]
+
+            buffered_size -= n
+            return head[:n]
+
+        result = []
+        while n and buffered:
+            head = buffered.popleft()
+            if len(head) > n:
+                buffered.appendleft(head[n:])
+                head = head[:n]
+
+            result.append(head)
+            n -= len(head)
+            buffered_size -= len(head)
+
+        return b''.join(result)
+
+    return reader
+
+
+_COMPRESSOR_READ_CHUNK = 1024 * 1024
+
+
+def _compress_stream(compressor, reader):
+    while True:
+        uncompressed = reader(_COMPRESSOR_READ_CHUNK)
+        if not uncompressed:
+            break
+
+        yield compressor.compress(uncompressed)
+
+    yield compressor.flush()
+
+
+def _check_threads(threads):
+    _check_type(threads, "threads", int, "int")
+
+    if threads < 0:
+        raise ValueError("threads must not be negative")
+
+    return threads or _os.cpu_count() or 1
+
+
 class _XzCompressor:
-    def wrap(self, reader):
-        READ_CHUNK = 1024 * 1024
-        compressor = _lzma.LZMACompressor()
+    def __init__(self, *, preset=None, threads=1, block_size=16 * 1024 * 1024):
+        if preset is not None:
+            _check_type(preset, "preset", int, "int")
 
-        compressed = []
-        compressed_pos = 0
-        eof = False
+        _check_type(block_size, "block_size", int, "int")
 
-        def reader_wrapper(n):
-            nonlocal compressed_pos
-            nonlocal eof
-
-            result = []
-
-            while n:  # pragma: no branch
-                while n and compressed:
-                    avail = min(n, len(compressed[0]) - compressed_pos)
-                    if avail == 0:
-                        compressed.pop(0)
-                        compressed_pos = 0
-                        continue
-
-                    result.append(compressed[0][compressed_pos:compressed_pos + avail])
-                    n -= avail
-                    compressed_pos += avail
-
-                if eof:
-                    break
-
-                if n:  # pragma: no branch
-                    uncompressed = reader(READ_CHUNK)
-                    if uncompressed:
-                        compressed.append(compressor.compress(uncompressed))
-                    else:
-                        eof = True
-                        compressed.append(compressor.flush())
+        if block_size <= 0:
+            raise ValueError("block_size must be positive")
+
+        self.preset = preset
+        self.threads = _check_threads(threads)
+        self.block_size = block_size
+
+        # shared by all files compressed concurrently (even by concurrent renders),
+        # started on first use
+        self._lock = _threading.Lock()
+        self._executor = None
+        self._executor_users = 0
+
+    def close(self):
+        # the executor may be in use by a concurrent render, which closes it once done
+        with self._lock:
+            if self._executor_users:
+                return
+
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown()
+
+    def _acquire_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = _futures.ThreadPoolExecutor(max_workers=self.threads)
+
+            self._executor_users += 1
+            return self._executor
+
+    def _release_executor(self):
+        with self._lock:
+            self._executor_users -= 1
+
+    def _compress_threaded(self, reader):
+        # each block is compressed as an independent .xz stream. Concatenation
+        # of streams is a valid .xz file, which is decoded by `unxz` as a whole.
+        # Note: lzma releases GIL while compressing.
+        block = reader(self.block_size)
+        next_block = reader(self.block_size) if block else b''
+
+        if not next_block:
+            # input fits into a single block, there is nothing to parallelize
+            yield _lzma.compress(block, preset=self.preset)
+            return
+
+        executor = self._acquire_executor()
+        pending = _collections.deque()
+
+        try:
+            for block in _itertools.chain([block, next_block], iter(lambda: reader(self.block_size), b'')):
+                if len(pending) >= 2 * self.threads:
+                    yield pending.popleft().result()
+
+                pending.append(executor.submit(_lzma.compress, block, preset=self.preset))
 
-            return b''.join(result)
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            self._release_executor()
 
-        return b'| unxz ', reader_wrapper
+    def cache_key(self):
+        result = b'xz-%r' % self.preset
+
+        # output of multi-threaded compression depends on block size
+        if self.threads > 1:
+            result += b'-blocks-%d' % self.block_size
+
+        return result
+
+    def wrap(self, reader):
+        if self.threads > 1:
+            chunks = self._compress_threaded(reader)
+        else:
+            chunks = _compress_stream(_lzma.LZMACompressor(preset=self.preset), reader)
+
+        return b'| unxz ', _make_chunks_reader(chunks)
 
 
 XzCompressor = _XzCompressor
@@ -122,29 +360,432 @@ Decompression is performed with the help of `unxz` tool (which is also available
 
 Note: the signature of this class is not a part of a public API, only the class itself and its constructor are.
 
+Args:
+    preset (int, optional): compression preset (level) in range 0-9. Defaults to `None`,
+        which is the default preset of :mod:`lzma`.
+    threads (int, optional): number of threads to use for compression. Defaults to `1`.
+        `0` means the number of CPUs. If greater than `1`, input is split into
+        blocks of `block_size` bytes, which are compressed concurrently into
+        independent concatenated .xz streams. Threads are shared by all files
+        and are stopped at the end of :func:`SharCreator.render`.
+    block_size (int, optional): size of uncompressed block for multi-threaded compression.
+        Defaults to 16 MiB. Smaller blocks allow more parallelism at the cost of compression ratio.
+
 .. _xz: https://en.wikipedia.org/wiki/Xz
 .. _BusyBox: https://en.wikipedia.org/wiki/BusyBox
 """
 
 
+class _GzipCompressor:
+    def __init__(self, *, level=6):
+        _check_type(level, "level", int, "int")
+        self.level = level
+
+    def cache_key(self):
+        return b'gzip-%d' % self.level
+
+    def close(self):
+        pass
+
+    def wrap(self, reader):
+        # wbits=31 selects gzip container format
+        compressor = _zlib.compressobj(self.level, _zlib.DEFLATED, 31)
+        return b'| gunzip ', _make_chunks_reader(_compress_stream(compressor, reader))
+
+
+GzipCompressor = _GzipCompressor
+"""Compressor class to compress data with gzip_ compression using :mod:`zlib`.
+Much faster than :class:`XzCompressor`, at the cost of compression ratio.
+Decompression is performed with the help of `gunzip` tool.
+
+Note: the signature of this class is not a part of a public API, only the class itself and its constructor are.
+
+Args:
+    level (int, optional): compression level in range 0-9. Defaults to `6`.
+
+.. _gzip: https://en.wikipedia.org/wiki/Gzip
+"""
+
+
+class _ZstdCompressor:
+    def __init__(self, *, level=3, threads=1):
+        _check_type(level, "level", int, "int")
+        self._zstandard = __import__('zstandard')
+        self.level = level
+        self.threads = _check_threads(threads)
+
+    def cache_key(self):
+        # multi-threaded compression produces different output
+        return b'zstd-%d-%d' % (self.level, self.threads > 1)
+
+    def close(self):
+        pass
+
+    def wrap(self, reader):
+        compressor = self._zstandard.ZstdCompressor(
+            level=self.level,
+            threads=self.threads if self.threads > 1 else 0
+        ).compressobj()
+        return b'| zstd -d ', _make_chunks_reader(_compress_stream(compressor, reader))
+
+
+ZstdCompressor = _ZstdCompressor
+"""Compressor class to compress data with zstd_ compression. Compression
+is performed with the help of zstandard_ package, which has to be installed separately
+(e.g. as ``tinyshar[zstd]`` extra).
+Offers good compression ratio at speeds much higher than :class:`XzCompressor`.
+Decompression is performed with the help of `zstd` tool.
+
+Note: the signature of this class is not a part of a public API, only the class itself and its constructor are.
+
+Args:
+    level (int, optional): compression level in range 1-22. Defaults to `3`.
+    threads (int, optional): number of threads to use for compression. Defaults to `1`.
+        `0` means the number of CPUs.
+
+Raises:
+    ImportError: If zstandard_ package is not installed.
+
+.. _zstd: https://en.wikipedia.org/wiki/Zstandard
+.. _zstandard: https://pypi.org/project/zstandard/
+"""
+
+
+class _AdaptiveCompressor:
+    def __init__(self, compressor, *, sample_size=64 * 1024, max_ratio=0.9, min_size=512):
+        _check_type(sample_size, "sample_size", int, "int")
+        _check_type(max_ratio, "max_ratio", (int, float), "'int' or 'float'")
+        _check_type(min_size, "min_size", int, "int")
+
+        if sample_size < min_size:
+            raise ValueError("sample_size must not be less than min_size")
+
+        self.compressor = compressor
+        self.sample_size = sample_size
+        self.max_ratio = max_ratio
+        self.min_size = min_size
+
+        self._lock = _threading.Lock()
+        self.files_compressed = 0
+        self.files_skipped = 0
+        self.bytes_sampled = 0
+        self.bytes_skipped = 0
+        self.sample_seconds = 0.0
+
+    @property
+    def estimated_seconds_saved(self):
+        """Estimation of time saved by not compressing incompressible files, extrapolated
+        from compression speed observed on samples."""
+        with self._lock:
+            if not self.bytes_sampled:
+                return 0.0
+
+            return self.bytes_skipped * self.sample_seconds / self.bytes_sampled
+
+    def cache_key(self):
+        return b'adaptive-%d-%r-%d-%s' % (self.sample_size, self.max_ratio, self.min_size, self.compressor.cache_key())
+
+    def close(self):
+        self.compressor.close()
+
+    def _compress_sample(self, sample):
+        """Return compressor pipe string and list of chunks of compressed `sample`."""
+        start = _time.perf_counter()
+        compressor_pipe_str, sample_reader = self.compressor.wrap(_make_chunks_reader([sample]))
+        compressed = list(iter(lambda: sample_reader(_COMPRESSOR_READ_CHUNK), b''))
+        elapsed = _time.perf_counter() - start
+
+        with self._lock:
+            self.bytes_sampled += len(sample)
+            self.sample_seconds += elapsed
+
+        return compressor_pipe_str, compressed
+
+    def wrap(self, reader):
+        sample = reader(self.sample_size)
+        head = [sample]
+
+        # the reader must not be called again once it has returned EOF,
+        # e.g. verifiers would record hashes twice
+        if sample:
+            head.append(reader(_COMPRESSOR_READ_CHUNK))
+
+        eof = not head[-1]
+        rest = () if eof else iter(lambda: reader(_COMPRESSOR_READ_CHUNK), b'')
+
+        if len(sample) >= self.min_size:
+            compressor_pipe_str, compressed = self._compress_sample(sample)
+
+            if sum(len(i) for i in compressed) <= len(sample) * self.max_ratio:
+                with self._lock:
+                    self.files_compressed += 1
+
+                # the compressed sample is not compressed again, but reused as the first
+                # of concatenated compressed streams, which are decompressed as a whole
+                if not eof:
+                    _, rest_reader = self.compressor.wrap(_make_chunks_reader(_itertools.chain(head[1:], rest)))
+                    compressed = _itertools.chain(compressed, iter(lambda: rest_reader(_COMPRESSOR_READ_CHUNK), b''))
+
+                return compressor_pipe_str, _make_chunks_reader(compressed)
+
+        with self._lock:
+            self.files_skipped += 1
+
+        full_reader = _make_chunks_reader(_itertools.chain(head, rest))
+
+        def counting_reader(n):
+            chunk = full_reader(n)
+
+            with self._lock:
+                self.bytes_skipped += len(chunk)
+
+            return chunk
+
+        return b'', counting_reader
+
+
+AdaptiveCompressor = _AdaptiveCompressor
+"""Compressor class which decides for each file whether to compress it
+with a given compressor, or to store it uncompressed. The decision is based on
+compressing a sample taken from the beginning of the file, so already compressed
+data (archives, images, etc.) does not waste time on futile compression.
+Small files are stored uncompressed, avoiding spawning a decompressor
+for each of them during extraction. The compressed sample is not compressed again,
+but is followed by the rest of the file compressed as a separate concatenated stream.
+
+Statistics are accumulated in ``files_compressed``, ``files_skipped``, ``bytes_sampled``,
+``bytes_skipped`` and ``sample_seconds`` attributes, and :attr:`estimated_seconds_saved` property.
+
+Note: the signature of this class is not a part of a public API, only the class itself,
+its constructor and statistics attributes are.
+
+Args:
+    compressor: Instance of a compressor class to be used for compressible files.
+    sample_size (int, optional): size of a sample in bytes. Defaults to 64 KiB.
+    max_ratio (float, optional): maximum ratio of compressed to uncompressed sample size
+        for the file to be considered compressible. Defaults to `0.9`.
+    min_size (int, optional): files (or rather, their samples) smaller than this number of bytes
+        are not compressed. Defaults to `512`.
+"""
+
+
+class _Spool:
+    _COPY_CHUNK = 1024 * 1024
+    _MAX_MEMORY_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, stm=None, start=0, size=0):
+        # data is kept in memory until it grows past _MAX_MEMORY_SIZE
+        self._stm = _io.BytesIO() if stm is None else stm
+        self._start = start
+        self.size = size
+
+    def close(self):
+        self._stm.close()
+
+    def write(self, data):
+        if isinstance(self._stm, _io.BytesIO) and self.size + len(data) > self._MAX_MEMORY_SIZE:
+            stm = _tempfile.TemporaryFile()
+
+            with self._stm.getbuffer() as buffer:
+                stm.write(buffer)
+
+            self._stm.close()
+            self._stm = stm
+
+        self._stm.write(data)
+        self.size += len(data)
+
+    def append(self, reader):
+        offset = self.size
+
+        while True:
+            chunk = reader(self._COPY_CHUNK)
+            if not chunk:
+                break
+
+            self.write(chunk)
+
+        return offset, self.size - offset
+
+    def chunks(self, skip=0):
+        self._stm.seek(self._start + skip)
+
+        while True:
+            chunk = self._stm.read(self._COPY_CHUNK)
+            if not chunk:
+                break
+
+            yield chunk
+
+    def copy_to(self, writer):
+        for chunk in self.chunks():
+            writer(chunk)
+
+    def reader(self):
+        return _make_chunks_reader(self.chunks())
+
+    def send_to(self, stm):
+        """Copy content to binary stream `stm`. If the spool is backed by a file and `stm`
+        is a plain file object (of a file or a pipe), data is copied by the kernel,
+        with :func:`os.sendfile`.
+        """
+        out_fd = _file_fileno(stm)
+
+        if out_fd is None or isinstance(self._stm, _io.BytesIO) or not hasattr(_os, 'sendfile'):
+            self.copy_to(stm.write)
+            return
+
+        self._stm.flush()
+        stm.flush()
+        in_fd = self._stm.fileno()
+        done = 0
+
+        try:
+            while done < self.size:
+                sent = _os.sendfile(out_fd, in_fd, self._start + done, self.size - done)
+                if not sent:  # pragma: no cover
+                    raise EOFError("spool file is truncated")
+
+                done += sent
+        except OSError:
+            # e.g. on platforms where sendfile only supports sockets
+            for chunk in self.chunks(done):
+                stm.write(chunk)
+
+
+class _Coalescer:
+    """Writer passing data to multiple writers, coalescing small writes."""
+    _BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, writers):
+        self._writers = writers
+        self._buffer = bytearray()
+
+    def _write_all(self, data):
+        for writer in self._writers:
+            writer(data)
+
+    def flush(self):
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            self._write_all(data)
+
+    def write(self, data):
+        if len(data) >= self._BUFFER_SIZE:
+            self.flush()
+            self._write_all(data)
+        else:
+            self._buffer += data
+            if len(self._buffer) >= self._BUFFER_SIZE:
+                self.flush()
+
+
+class _FanOut:
+    """Writer passing script text to output writers and to skeleton writers (i.e. build-time
+    validators). Payload bodies (and other content dependent parts of the script, e.g. hashes)
+    are passed to output writers only, while skeleton writers get a placeholder instead of each body.
+    """
+    def __init__(self, output_writers, skeleton_writers):
+        self._output = _Coalescer(output_writers)
+        self._skeleton = _Coalescer(skeleton_writers)
+
+        if not skeleton_writers:
+            self.write = self._output.write
+
+    def flush(self):
+        self._output.flush()
+        self._skeleton.flush()
+
+    def write(self, data):
+        self._output.write(data)
+        self._skeleton.write(data)
+
+    def body_writer(self, placeholder):
+        """Return a writer for a single payload body, which is replaced by `placeholder` in the skeleton."""
+        placeholder = [placeholder]
+
+        def writer(data):
+            if placeholder:
+                self._skeleton.write(placeholder.pop())
+
+            self._output.write(data)
+
+        return writer
+
+
+def _wrap_compressor(compressor, reader, probe):
+    compressor_pipe_str, compressor_reader = compressor.wrap(reader)
+
+    if probe is not None:
+        compressor_reader = probe.reader('compress', compressor_reader)
+
+    return compressor_pipe_str, compressor_reader
+
+
 class _Base64Encoder:
     _MAXBINSIZE = 57
+    # number of lines encoded at once
+    _BLOCK_LINES = 1024
+    binary_payload = False
+    # replaces payload bodies in the skeleton passed to build-time validators
+    body_placeholder = b'# payload elided\n'
 
     def __init__(self, *, compressor=None):
         self.compressor = compressor or NoCompressor()
 
-    def encode(self, dest, reader, writer):
-        compressor_pipe_str, compressor_reader = self.compressor.wrap(reader)
+    def cache_key(self):
+        return b'base64-' + self.compressor.cache_key()
+
+    def close(self):
+        self.compressor.close()
 
-        writer(b"base64 -d << '_END_' %s> '%s'\n" % (compressor_pipe_str, dest))
+    def _encode_body(self, reader, writer):
+        maxbinsize = self._MAXBINSIZE
+        b2a_base64 = _binascii.b2a_base64
+        rest = b''
 
         while True:
-            chunk = compressor_reader(self._MAXBINSIZE)
+            chunk = reader(maxbinsize * self._BLOCK_LINES)
             if not chunk:
                 break
 
-            writer(_binascii.b2a_base64(chunk))
+            if rest:
+                chunk = rest + chunk
+
+            # only the very last line is allowed to be shorter
+            tail = len(chunk) % maxbinsize
+            if tail:
+                rest = bytes(chunk[-tail:])
+                chunk = chunk[:-tail]
+            else:
+                rest = b''
+
+            writer(b''.join([b2a_base64(chunk[i:i + maxbinsize]) for i in range(0, len(chunk), maxbinsize)]))
+
+        if rest:
+            writer(b2a_base64(rest))
 
+    def _emit_header(self, sink, compressor_pipe_str, writer):
+        writer(b"base64 -d << '_END_' %s%s\n" % (compressor_pipe_str, sink))
+
+    def encode(self, sink, reader, writer, payload, probe=None, body_writer=None):
+        compressor_pipe_str, compressor_reader = _wrap_compressor(self.compressor, reader, probe)
+        self._emit_header(sink, compressor_pipe_str, writer)
+        self._encode_body(compressor_reader, body_writer or writer)
+        writer(b"_END_\n")
+
+    def prepare(self, reader, probe=None):
+        compressor_pipe_str, compressor_reader = _wrap_compressor(self.compressor, reader, probe)
+        body = _Spool()
+        self._encode_body(compressor_reader, body.write)
+        return compressor_pipe_str, body
+
+    def emit(self, sink, prepared, writer, payload, body_writer=None):
+        compressor_pipe_str, body = prepared
+        self._emit_header(sink, compressor_pipe_str, writer)
+        body.copy_to(body_writer or writer)
+        body.close()
         writer(b"_END_\n")
 
 
@@ -161,66 +802,394 @@ Args:
 """
 
 
+class _RawEncoder:
+    binary_payload = True
+    # replaces payload offset and size in the skeleton passed to build-time validators
+    body_placeholder = b'0 0'
+
+    def __init__(self, *, compressor=None):
+        self.compressor = compressor or NoCompressor()
+
+    def cache_key(self):
+        return b'raw-' + self.compressor.cache_key()
+
+    def close(self):
+        self.compressor.close()
+
+    def _emit_command(self, sink, compressor_pipe_str, offset, size, writer, body_writer):
+        writer(b"tinyshar_payload ")
+        (body_writer or writer)(b"%d %d" % (offset, size))
+        writer(b" %s%s\n" % (compressor_pipe_str, sink))
+
+    def encode(self, sink, reader, writer, payload, probe=None, body_writer=None):
+        compressor_pipe_str, compressor_reader = _wrap_compressor(self.compressor, reader, probe)
+        offset, size = payload.append(compressor_reader)
+        self._emit_command(sink, compressor_pipe_str, offset, size, writer, body_writer)
+
+    def prepare(self, reader, probe=None):
+        compressor_pipe_str, compressor_reader = _wrap_compressor(self.compressor, reader, probe)
+        data = _Spool()
+        data.append(compressor_reader)
+        return compressor_pipe_str, data
+
+    def emit(self, sink, prepared, writer, payload, body_writer=None):
+        compressor_pipe_str, data = prepared
+        offset = payload.size
+        data.copy_to(payload.write)
+        data.close()
+        self._emit_command(sink, compressor_pipe_str, offset, data.size, writer, body_writer)
+
+
+RawEncoder = _RawEncoder
+"""Data encoder class which appends raw (optionally compressed) file contents
+after the end of the script, instead of embedding them as here-documents.
+Avoids the overhead of base64 encoding, both in size and in extraction time.
+
+Data is extracted with the help of `tail` and `head` tools, using offsets computed
+at render time. Note: produced script must be executed from a file (i.e. not
+piped into a shell), as it reads its own contents.
+
+Note: the signature of this class is not a part of a public API, only the class itself and its constructor are.
+
+Args:
+    compressor (optional): Instance of a compressor class. Defaults to `None`
+        which is a shortcut for :class:`NoCompressor`. See also :class:`XzCompressor`.
+"""
+
+
+class _DirCache:
+    def __init__(self, path, max_size):
+        _check_type(max_size, "max_size", int, "int")
+        self.path = path
+        self.max_size = max_size
+        _os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, key):
+        return _os.path.join(self.path, key)
+
+    def open(self, key):
+        """Return an opened entry, or `None` if there is no such entry."""
+        path = self._entry_path(key)
+
+        try:
+            stm = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+        # modification time is used to track recency of use.
+        # The entry may have been evicted (by another process) in the meanwhile.
+        _os.utime(stm.fileno())
+
+        return stm
+
+    def store(self, key, chunks):
+        """Atomically store an entry."""
+        with _tempfile.NamedTemporaryFile(dir=self.path, prefix='.tmp', delete=False) as stm:
+            try:
+                for chunk in chunks:
+                    stm.write(chunk)
+            except BaseException:
+                stm.close()
+                _os.unlink(stm.name)
+                raise
+
+        _os.replace(stm.name, self._entry_path(key))
+
+    def trim(self):
+        """Evict least recently used entries until total size fits into `max_size`."""
+        entries = []
+
+        with _os.scandir(self.path) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total_size = sum(i[1] for i in entries)
+
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                _os.unlink(path)
+            except FileNotFoundError:  # pragma: no cover
+                pass
+
+            total_size -= size
+
+
+class PayloadCache:
+    """Persistent on-disk cache of encoded file contents, to be passed to :func:`SharCreator.render`.
+
+    Entries are keyed by a hash of file content and encoder (and compressor) settings,
+    so unchanged files are not compressed and encoded again by subsequent renders.
+    Least recently used entries are evicted at the end of each render to keep
+    the total size of the cache within `max_size`.
+
+    Note: file contents still have to be read and hashed, thus extraction-time
+    verification hashes are always computed from actual contents.
+
+    Args:
+        path (str): directory to keep cache entries in. Created if does not exist.
+        max_size (int, optional): maximum total size of cache entries in bytes.
+            Defaults to 1 GiB.
+    """
+    def __init__(self, path, *, max_size=1024 * 1024 * 1024):
+        self._dir_cache = _DirCache(path, max_size)
+
+    def _key(self, encoder, digest):
+        return _hashlib.sha256(digest + b'\0' + encoder.cache_key()).hexdigest()
+
+    def _get(self, key):
+        stm = self._dir_cache.open(key)
+        if stm is None:
+            return None
+
+        compressor_pipe_str = stm.readline()[:-1]
+        start = stm.tell()
+        return compressor_pipe_str, _Spool(stm, start, _os.fstat(stm.fileno()).st_size - start)
+
+    def _put(self, key, prepared):
+        compressor_pipe_str, spool = prepared
+        self._dir_cache.store(key, _itertools.chain([compressor_pipe_str + b'\n'], spool.chunks()))
+
+    def _prepare(self, encoder, digest, reader, probe=None):
+        key = self._key(encoder, digest)
+        prepared = self._get(key)
+
+        if prepared is None:
+            prepared = encoder.prepare(reader, probe)
+            self._put(key, prepared)
+
+        return prepared
+
+    def _trim(self):
+        self._dir_cache.trim()
+
+
 class ValidatorError(RuntimeError):
     """Build-time validation failure."""
 
 
 @_contextlib.contextmanager
-def ShellcheckValidator():
+def _run_shellcheck(shellcheck):
+    with _subprocess.Popen(
+        [shellcheck, '-'],
+        stdin=_subprocess.PIPE,
+        stdout=_subprocess.PIPE,
+    ) as process:
+        chunks = _queue.Queue()
+        outs = []
+
+        def feed():
+            # shellcheck exiting early is reported via its return code
+            with _contextlib.suppress(BrokenPipeError), process.stdin:
+                for chunk in iter(chunks.get, None):
+                    process.stdin.write(chunk)
+
+        def drain():
+            outs.append(process.stdout.read())
+
+        threads = [_threading.Thread(target=i, daemon=True) for i in (feed, drain)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            yield chunks.put
+        finally:
+            chunks.put(None)
+
+            for thread in threads:
+                thread.join()
+
+            process.wait()
+
+        if process.returncode != 0:
+            raise ValidatorError("shellcheck failed", b''.join(outs))
+
+
+@_contextlib.contextmanager
+def ShellcheckValidator(*, cache_dir=None, cache_size=1024 * 1024):
     """Build-time validator of resulting shell script using shellcheck_.
     In case of validation failure, any stdout output from `shellcheck`
     will be available as ``args[1]`` of the raised :class:`ValidatorError` exception.
 
-    Note: huge output from shellcheck may theoretically cause a deadlock.
-    If this ever becomes a real issue, a solution suggested here_ should be used.
+    Only the skeleton of the script is validated, i.e. bodies of here-documents
+    containing file contents are replaced by a placeholder line.
+    `shellcheck` runs concurrently with rendering: the skeleton is queued and fed to it,
+    and its output is drained, by background threads.
+
+    If `cache_dir` is specified, hashes of skeletons which passed validation are
+    remembered there, so that validation of an unchanged skeleton is skipped altogether.
+    In this case the skeleton is buffered and `shellcheck` is run at the end of rendering,
+    only if needed. Entries are keyed by the skeleton and the location and modification
+    time of `shellcheck` executable. Failures are not cached.
 
     Note: the signature of this class is not a part of a public API, only the class itself and its constructor are.
 
+    Args:
+        cache_dir (str, optional): directory to keep cache entries in. Created if does not exist.
+            Defaults to `None`, i.e. no caching.
+        cache_size (int, optional): maximum total size of cache entries in bytes.
+            Least recently used entries are evicted. Defaults to 1 MiB.
+
     Raises:
         FileNotFoundError: If `shellcheck` is not found on `PATH`.
 
     .. _shellcheck: https://www.shellcheck.net/
-    .. _here: http://eyalarubas.com/python-subproc-nonblock.html
     """
-    with _subprocess.Popen(
-        [_checked_which('shellcheck'), '-'],
-        stdin=_subprocess.PIPE,
-        stdout=_subprocess.PIPE,
-    ) as process:
-        yield process.stdin.write
+    shellcheck = _checked_which('shellcheck')
 
-        outs, errs = process.communicate()
+    if cache_dir is None:
+        with _run_shellcheck(shellcheck) as writer:
+            yield writer
 
-        if process.returncode != 0:
-            raise ValidatorError("shellcheck failed", outs)
+        return
 
+    cache = _DirCache(cache_dir, cache_size)
+    digest = _hashlib.sha256(b'shellcheck\0%s\0%d\0' % (shellcheck.encode(), _os.stat(shellcheck).st_mtime_ns))
+    chunks = []
 
-class _Md5Verifier:
-    def __init__(self):
+    def writer(data):
+        digest.update(data)
+        chunks.append(data)
+
+    yield writer
+
+    key = digest.hexdigest()
+    stm = cache.open(key)
+
+    if stm is not None:
+        stm.close()
+        return
+
+    with _run_shellcheck(shellcheck) as shellcheck_writer:
+        for chunk in chunks:
+            shellcheck_writer(chunk)
+
+    cache.store(key, [b'passed\n'])
+    cache.trim()
+
+
+class _HashVerifier:
+    # name of a tool compatible with md5sum (i.e. supporting -c) and a hashlib-like constructor
+    _tool = None
+    _new_hash = None
+
+    def __init__(self, *, jobs=1, inline=False):
+        _check_type(jobs, "jobs", int, "int")
+        if jobs < 1:
+            raise ValueError("jobs must be positive")
+
+        self.jobs = jobs
+        self.inline = inline
         self.hashes = []
+        self._sizes = {}
+        self._digests = {}
+        # names of files verified inline
+        self._verified = set()
 
     def wrap_reader(self, reader, fname):
-        md5 = _hashlib.md5()
+        h = self._new_hash()
+        size = 0
 
         def reader_wrapper(n):
+            nonlocal size
             chunk = reader(n)
 
             if chunk:
-                md5.update(chunk)
+                h.update(chunk)
+                size += len(chunk)
             else:
-                self.hashes.append((fname, md5.hexdigest().encode()))
+                digest = h.hexdigest().encode()
+                self.hashes.append((fname, digest))
+                self._sizes[fname] = size
+                self._digests[fname] = digest
 
             return chunk
 
         return reader_wrapper
 
-    def render(self, writer):
-        writer(b"md5sum -c << '_END_'\n")
-        for fname, md5 in self.hashes:
-            writer(b"%s  %s\n" % (md5, fname))
+    def inline_sink(self, fname, sum_fname=None):
+        """Return a sink hashing data being extracted to `fname` on the fly.
+        The hash is written to `sum_fname`, which defaults to `fname` with ``.sum`` appended.
+        """
+        return b"| tee %s | %s > %s" % (_quote(fname), self._tool, _quote(sum_fname or fname + b'.sum'))
+
+    def render_inline(self, fname, writer, sum_fname=None, body_writer=None):
+        """Render a check of the hash computed by :func:`inline_sink`.
+        The expected hash is written with `body_writer`, if given.
+        """
+        writer(b"test \"$(cut -d ' ' -f 1 %s)\" = " % _quote(sum_fname or fname + b'.sum'))
+        (body_writer or writer)(self._digests[fname])
+        writer(b"\n")
+        self._verified.add(fname)
+
+    def _shards(self, hashes, jobs):
+        """Split hashes into at most `jobs` non-empty groups of about the same total size
+        of files. Ties are broken by number of files, so empty files are spread as well.
+        """
+        shards = [[] for _ in range(jobs)]
+        loads = [(0, 0, i) for i in range(jobs)]
+
+        for fname, digest in sorted(hashes, key=lambda i: (-self._sizes[i[0]], i)):
+            load, count, i = _heapq.heappop(loads)
+            shards[i].append((fname, digest))
+            _heapq.heappush(loads, (load + self._sizes[fname], count + 1, i))
+
+        # `md5sum -c` fails given no lines at all
+        return [i for i in shards if i]
+
+    def render(self, writer, new_body_writer=None):
+        """Render verification of hashes not checked inline. If given, `new_body_writer`
+        is called to get a writer of each list of hashes.
+        """
+        hashes = [i for i in self.hashes if i[0] not in self._verified]
+        jobs = min(self.jobs, len(hashes))
+
+        if not hashes:
+            return
+
+        if jobs == 1:
+            self._render_hashes(writer, new_body_writer, hashes, b'')
+            return
+
+        # shards are verified by background jobs, and the script fails
+        # after all of them have finished, if any of them has failed
+        # (plain variables, as arrays are not available in POSIX shells)
+        shards = self._shards(hashes, jobs)
+
+        for n, shard in enumerate(shards):
+            self._render_hashes(writer, new_body_writer, shard, b' &')
+            writer(b"tinyshar_pid_%d=$!\n" % n)
+
+        writer(b"tinyshar_failed=0\n")
+
+        for n in range(len(shards)):
+            writer(b'wait "$tinyshar_pid_%d" || tinyshar_failed=1\n' % n)
+
+        writer(b'test "$tinyshar_failed" = 0\n')
+
+    def _render_hashes(self, writer, new_body_writer, hashes, suffix):
+        writer(b"%s -c << '_END_'%s\n" % (self._tool, suffix))
+        body_writer = writer if new_body_writer is None else new_body_writer(b'# hashes elided\n')
+
+        for fname, digest in sorted(hashes):
+            if b'\\' in fname or b'\n' in fname:
+                # md5sum convention for names with special characters
+                body_writer(b"\\%s  %s\n" % (digest, fname.replace(b'\\', b'\\\\').replace(b'\n', b'\\n')))
+            else:
+                body_writer(b"%s  %s\n" % (digest, fname))
+
         writer(b"_END_\n")
 
 
+class _Md5Verifier(_HashVerifier):
+    _tool = b'md5sum'
+    _new_hash = staticmethod(_hashlib.md5)
+
+
 Md5Verifier = _Md5Verifier
 """Class for MD5 extraction-time verification.
 
@@ -231,16 +1200,561 @@ Note, according to wiki_ (the **bold** emphasis is ours):
     can still be used as a checksum to **verify data integrity**, but only against
     **unintentional corruption**.
 
+Args:
+    jobs (int, optional): number of parallel jobs files are verified by at extraction time.
+        Files are split into groups of about the same total size, each verified by
+        a background job. Defaults to `1`.
+    inline (bool, optional): specifies whether files are to be hashed while being extracted
+        (by piping decoded data through both ``tee`` and the hash tool), and checked right away,
+        instead of being read back after all files are extracted. Files which are not
+        extracted individually (i.e. duplicates with `dedup` and all files in `solid` mode)
+        are still checked after extraction. At most one verifier passed to
+        :func:`SharCreator.render` may be inline. Defaults to `False`.
+
+Raises:
+    ValueError: If `jobs` is not positive.
+
 .. _wiki: https://en.wikipedia.org/wiki/MD5
 """
 
 
+class _Sha256Verifier(_HashVerifier):
+    _tool = b'sha256sum'
+    _new_hash = staticmethod(_hashlib.sha256)
+
+
+Sha256Verifier = _Sha256Verifier
+"""Class for SHA-256 extraction-time verification, using `sha256sum` tool.
+Slower than :class:`Md5Verifier`, unless the CPU offers SHA extensions.
+Accepts the same arguments as :class:`Md5Verifier`.
+"""
+
+
+class _Blake2Verifier(_HashVerifier):
+    _tool = b'b2sum'
+    _new_hash = staticmethod(_hashlib.blake2b)
+
+
+Blake2Verifier = _Blake2Verifier
+"""Class for BLAKE2b extraction-time verification, using `b2sum` tool from coreutils.
+Typically faster than both :class:`Md5Verifier` and :class:`Sha256Verifier` on 64-bit CPUs.
+Accepts the same arguments as :class:`Md5Verifier`.
+"""
+
+
+class _XxhashVerifier(_HashVerifier):
+    _tool = b'xxhsum'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._new_hash = __import__('xxhash').xxh64
+
+
+XxhashVerifier = _XxhashVerifier
+"""Class for XXH64 extraction-time verification, using `xxhsum` tool.
+Hashing is performed with the help of xxhash_ package, which has to be installed separately
+(e.g. as ``tinyshar[xxhash]`` extra).
+XXH64 is not a cryptographic hash, but is many times faster than any of the above.
+Accepts the same arguments as :class:`Md5Verifier`.
+
+Raises:
+    ImportError: If xxhash_ package is not installed.
+
+.. _xxhash: https://pypi.org/project/xxhash/
+"""
+
+
+class _Cancelled(Exception):
+    """Raised in the rendering thread of :func:`SharCreator.render_iter` once the consumer is gone."""
+
+
+class _Channel:
+    """FIFO of chunks passed from a producer thread to a consumer.
+
+    Chunks not fitting into `max_memory` either block the producer until the consumer
+    catches up, or (if `spill` is set) are spilled to a temporary file.
+    """
+    def __init__(self, max_memory, spill):
+        self._max_memory = max_memory
+        self._spill = spill
+        self._cond = _threading.Condition()
+        # each item is either bytes, or a (offset, size) of a chunk in the spill file
+        self._items = _collections.deque()
+        self._memory = 0
+        self._spill_stm = None
+        self._spill_size = 0
+        self._done = False
+        self._error = None
+        self._closed = False
+
+    def put(self, chunk):
+        with self._cond:
+            while (
+                not self._spill and not self._closed and self._items and
+                self._memory + len(chunk) > self._max_memory
+            ):
+                self._cond.wait()
+
+            if self._closed:
+                raise _Cancelled()
+
+            if self._memory + len(chunk) <= self._max_memory or not self._items:
+                self._items.append(chunk)
+                self._memory += len(chunk)
+            else:
+                if self._spill_stm is None:
+                    self._spill_stm = _tempfile.TemporaryFile()
+
+                self._spill_stm.seek(self._spill_size)
+                self._spill_stm.write(chunk)
+                self._items.append((self._spill_size, len(chunk)))
+                self._spill_size += len(chunk)
+
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self._done = True
+            self._error = error
+            self._cond.notify_all()
+
+    def get(self):
+        """Return the next chunk, or `None` once the producer has finished."""
+        with self._cond:
+            while not self._items and not self._done:
+                self._cond.wait()
+
+            if not self._items:
+                if self._error is not None:
+                    raise self._error
+
+                return None
+
+            item = self._items.popleft()
+            self._cond.notify_all()
+
+            if isinstance(item, bytes):
+                self._memory -= len(item)
+                return item
+
+            offset, size = item
+            self._spill_stm.seek(offset)
+            return self._spill_stm.read(size)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+            if self._spill_stm is not None:
+                self._spill_stm.close()
+
+
+class _ChunkWriter:
+    """Output stream passing data to `writer` in chunks of at least `chunk_size` bytes."""
+    def __init__(self, writer, chunk_size):
+        self._writer = writer
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+
+    def flush(self):
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            self._writer(data)
+
+    def write(self, data):
+        if not self._buffer and len(data) >= self._chunk_size:
+            self._writer(bytes(data))
+            return
+
+        self._buffer += data
+
+        if len(self._buffer) >= self._chunk_size:
+            self.flush()
+
+
+class _NullProbe:
+    def reader(self, phase, reader):
+        return reader
+
+    def writer(self, writer):
+        return writer
+
+    def timed(self, phase, fn):
+        return fn
+
+    def count(self, phase, n):
+        pass
+
+    def report(self):
+        pass
+
+
+_NULL_PROBE = _NullProbe()
+
+
+class _Probe:
+    """Collects timings and byte counts of processing phases of a single file.
+
+    Timed calls may nest (e.g. the compressor reads through verifiers which read the file),
+    so the time of nested calls made by the same thread is subtracted, leaving the time
+    spent exclusively in each phase.
+    """
+    def __init__(self, stats, name, local):
+        self._stats = stats
+        self._name = name
+        self._local = local
+        self._seconds = _collections.defaultdict(float)
+        self._bytes = _collections.defaultdict(int)
+
+    def timed(self, phase, fn):
+        local = self._local
+        seconds = self._seconds
+
+        def wrapper(*args, **kwargs):
+            saved = getattr(local, 'nested', 0.0)
+            local.nested = 0.0
+            start = _time.perf_counter()
+
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = _time.perf_counter() - start
+                seconds[phase] += elapsed - local.nested
+                local.nested = saved + elapsed
+
+        return wrapper
+
+    def reader(self, phase, reader):
+        timed = self.timed(phase, reader)
+        counts = self._bytes
+
+        def wrapper(n):
+            chunk = timed(n)
+            counts[phase] += len(chunk)
+            return chunk
+
+        return wrapper
+
+    def writer(self, writer):
+        timed = self.timed('write', writer)
+        counts = self._bytes
+
+        def wrapper(data):
+            counts['write'] += len(data)
+            timed(data)
+
+        return wrapper
+
+    def count(self, phase, n):
+        self._bytes[phase] += n
+
+    def report(self):
+        if self._name is None:
+            # render wide phases
+            for phase, seconds in self._seconds.items():
+                self._stats.render_phase(phase, seconds)
+
+            return
+
+        counts = self._bytes
+        # in solid mode, the tar stream is read from spooled members
+        content = counts['read'] or counts['spool']
+        encoded = counts['compress'] if 'compress' in self._seconds else content
+        sizes = dict(
+            read=(content, content),
+            verify=(content, counts['verify']),
+            spool=(content, content),
+            compress=(content, counts['compress']),
+            encode=(encoded, counts['write'] + counts['payload']),
+            write=(counts['write'], counts['write']),
+        )
+
+        for phase in RenderStats.PHASES:
+            if phase in self._seconds:
+                self._stats.file_phase(self._name, phase, *sizes[phase], self._seconds[phase])
+
+
+@_contextlib.contextmanager
+def _timed_validator(validator, probe):
+    enter = probe.timed('validate', validator.__enter__)
+    leave = probe.timed('validate', validator.__exit__)
+    writer = enter()
+
+    try:
+        yield probe.timed('validate', writer)
+    except BaseException as e:
+        # build-time validators never suppress exceptions
+        leave(type(e), e, e.__traceback__)
+        raise
+    else:
+        leave(None, None, None)
+
+
+class RenderStats:
+    """Collector of render statistics, to be passed as `stats` to :func:`SharCreator.render`.
+
+    For each file and each processing phase, the number of bytes entering and leaving
+    the phase and the time spent exclusively in it (i.e. not counting time spent in
+    other phases it calls into) are recorded. Phases are:
+
+    * ``read``: reading file content
+    * ``verify``: computing hashes for extraction-time verification
+    * ``spool``: hashing and spooling file content (with `dedup` or `cache`)
+    * ``compress``: compression
+    * ``encode``: encoding, including lookups in the cache
+    * ``write``: passing encoded data to build-time validators and output
+
+    In `solid` mode, compression and encoding is accounted to a single ``<solid>`` entry.
+    Note: with `workers`, phases of different files overlap in time, so the sum
+    of times may exceed the total time of rendering.
+
+    Render wide phases are ``validate`` (time spent in build-time validators, e.g. waiting
+    for `shellcheck`), which is not included in the ``write`` phase of files,
+    and ``total``.
+
+    Any other object implementing :func:`file_phase` and :func:`render_phase` methods
+    can be passed as `stats` instead. These are always called from the thread invoking
+    :func:`SharCreator.render`.
+
+    Attributes:
+        files (dict): maps file names to dicts mapping phase names to ``[bytes_in, bytes_out, seconds]``.
+        phases (dict): maps phase names to ``[files, bytes_in, bytes_out, seconds]`` totals.
+        render_seconds (dict): maps render wide phase names to seconds.
+    """
+    PHASES = ('read', 'verify', 'spool', 'compress', 'encode', 'write')
+
+    def __init__(self):
+        self.files = {}
+        self.phases = {}
+        self.render_seconds = {}
+
+    def file_phase(self, name, phase, bytes_in, bytes_out, seconds):
+        """Record `seconds` spent in `phase` of processing file `name`."""
+        entry = self.files.setdefault(name, {}).setdefault(phase, [0, 0, 0.0])
+        entry[0] += bytes_in
+        entry[1] += bytes_out
+        entry[2] += seconds
+
+        total = self.phases.setdefault(phase, [0, 0, 0, 0.0])
+        total[0] += 1
+        total[1] += bytes_in
+        total[2] += bytes_out
+        total[3] += seconds
+
+    def render_phase(self, phase, seconds):
+        """Record `seconds` spent in render wide `phase`."""
+        self.render_seconds[phase] = self.render_seconds.get(phase, 0.0) + seconds
+
+    def slowest_files(self, n=10):
+        """Return a list of up to `n` ``(seconds, name)`` tuples for files which took the longest to process."""
+        return sorted(
+            ((sum(i[2] for i in phases.values()), name) for name, phases in self.files.items()),
+            key=lambda i: (-i[0], i[1])
+        )[:n]
+
+    def summary(self, slowest=10):
+        """Return a human readable summary table, followed by a list of `slowest` files."""
+        lines = ["%-10s %8s %14s %14s %10s %10s" % ('phase', 'files', 'bytes in', 'bytes out', 'seconds', 'MiB/s')]
+
+        for phase in self.PHASES:
+            if phase in self.phases:
+                files, bytes_in, bytes_out, seconds = self.phases[phase]
+                lines.append("%-10s %8d %14d %14d %10.3f %10s" % (
+                    phase, files, bytes_in, bytes_out, seconds,
+                    "%.1f" % (bytes_in / seconds / 1024 / 1024) if seconds else '-'
+                ))
+
+        for phase, seconds in sorted(self.render_seconds.items(), key=lambda i: i[0] == 'total'):
+            lines.append("%-10s %8s %14s %14s %10.3f" % (phase, '', '', '', seconds))
+
+        slowest_files = self.slowest_files(slowest)
+        if slowest_files:
+            lines.append("")
+            lines.append("slowest files:")
+
+            for seconds, name in slowest_files:
+                phases = self.files[name]
+                lines.append("%10.3f  %s (%s)" % (seconds, name, ', '.join(
+                    "%s %.3f" % (phase, phases[phase][2]) for phase in self.PHASES if phase in phases
+                )))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _scan_dir(src, follow_symlinks):
+    """Return a list of (name, kind, entry) of entries of directory `src` sorted by name,
+    where kind is either ``'file'``, ``'dir'`` or `None`.
+    """
+    result = []
+
+    with _os.scandir(src) as it:
+        for entry in it:
+            if entry.is_file():
+                kind = 'file'
+            elif entry.is_dir(follow_symlinks=follow_symlinks):
+                kind = 'dir'
+            else:
+                kind = None
+
+            result.append((entry.name, kind, entry))
+
+    result.sort(key=lambda i: i[0])
+    return result
+
+
+def _walk_dir(src, dest, follow_symlinks, scan_workers):
+    """Yield (src_name, dest_name, entry) of files in directory `src`, recursively.
+
+    Entries of each directory are sorted by name, so the order does not depend on
+    the file system. With `scan_workers` > 1, subdirectories are listed by a pool of threads
+    as soon as their parent directory is, while the order of results is preserved.
+    """
+    with _contextlib.ExitStack() as exit_stack:
+        if scan_workers == 1:
+            def scan(path):
+                return lambda: _scan_dir(path, follow_symlinks)
+        else:
+            executor = exit_stack.enter_context(_futures.ThreadPoolExecutor(max_workers=scan_workers))
+
+            def scan(path):
+                return executor.submit(_scan_dir, path, follow_symlinks).result
+
+        def walk(src, dest, listing):
+            listing = listing()
+            subdirs = dict(
+                (name, scan(_os.path.join(src, name)))
+                for name, kind, _ in listing
+                if kind == 'dir'
+            )
+
+            for name, kind, entry in listing:
+                src_name = _os.path.join(src, name)
+                dest_name = _posixpath.join(dest, name)
+                if kind == 'file':
+                    yield src_name, dest_name, entry
+                elif kind == 'dir':
+                    yield from walk(src_name, dest_name, subdirs[name])
+                else:
+                    raise ValueError("do not know how to deal with " + src_name)
+
+        yield from walk(src, dest, scan(src))
+
+
+# marks files among children of _PathNode
+_FILE_NODE = object()
+
+
+class _PathNode:
+    __slots__ = ('children',)
+
+    def __init__(self):
+        self.children = {}
+
+
+class _PathTree:
+    """Trie of path components of added files.
+
+    Absolute paths are rooted at the ``''`` child of the root node. Files are
+    leaves marked with `_FILE_NODE`, all other nodes are directories.
+
+    If `base` tree is given, added paths are checked for conflicts with paths
+    of `base` as well, though `base` itself is not modified.
+    """
+    def __init__(self, base=None):
+        self._root = _PathNode()
+        self._base = base
+
+    def _find(self, components):
+        """Return the deepest existing directory node on the path to a file
+        and its depth, raising if the file conflicts with already added paths.
+        """
+        node = self._root
+        last = len(components) - 1
+        depth = 0
+
+        while depth < last:
+            child = node.children.get(components[depth])
+            if child is None:
+                break
+
+            if child is _FILE_NODE:
+                raise FileExistsError('/'.join(components[:depth + 1]))
+
+            node = child
+            depth += 1
+        else:
+            existing = node.children.get(components[last])
+            if existing is _FILE_NODE:
+                raise FileExistsError('/'.join(components))
+            if existing is not None:
+                raise IsADirectoryError('/'.join(components))
+
+        return node, depth
+
+    def add_file(self, components):
+        """Add a file, checking for conflicts with already added paths in O(depth).
+        The tree is left intact if an exception is raised.
+        """
+        if self._base is not None:
+            self._base._find(components)
+
+        node, depth = self._find(components)
+        last = len(components) - 1
+
+        for component in components[depth:last]:
+            child = _PathNode()
+            node.children[component] = child
+            node = child
+
+        node.children[components[last]] = _FILE_NODE
+
+    def leaf_dirs(self):
+        """Yield component tuples of directories which contain no subdirectories, in sorted order.
+
+        The arena and the root (``/``) directories are never yielded.
+        """
+        stack = [((), self._root)]
+
+        while stack:
+            path, node = stack.pop()
+            subdirs = sorted(
+                ((name, child) for name, child in node.children.items() if child is not _FILE_NODE),
+                key=lambda i: i[0],
+                reverse=True
+            )
+
+            if subdirs:
+                stack.extend((path + (name,), child) for name, child in subdirs)
+            elif path and path != ('',):
+                yield path
+
+
+class _PendingFile:
+    """A file being prepared by a worker of :func:`SharCreator.render`, not yet emitted."""
+    __slots__ = ('tmp_name', 'name', 'path', 'probe', 'future', 'decided', 'original')
+
+    def __init__(self, tmp_name, name, path, probe, future, decided):
+        self.tmp_name = tmp_name
+        self.name = name
+        self.path = path
+        self.probe = probe
+        # result of either spooling or preparing the file
+        self.future = future
+        # whether it is known if the file is a duplicate
+        self.decided = decided
+        # path of the file this one is a duplicate of
+        self.original = None
+
+
 class SharCreator:
     """Class for creation of "active" self-extracting shell archives.
     """
     def __init__(self):
         self._files = {}
-        self._dirs = set()
+        self._tree = _PathTree()
+        self._lazy_dirs = []
         self._pre_chunks = []
         self._post_chunks = []
         self._files_by_tag = _collections.defaultdict(lambda: [])
@@ -295,22 +1809,7 @@ class SharCreator:
         if name in ['.', '/']:
             raise IsADirectoryError(name)
 
-        if name in self._files:
-            raise FileExistsError(name)
-
-        components = tuple(name.split('/'))
-        if components in self._dirs:
-            raise IsADirectoryError(name)
-
-        is_abs = components[0] == ''
-        for depth in range(1 + int(is_abs), len(components)):
-            components_prefix = components[:depth]
-            joined_components_prefix = '/'.join(components_prefix)
-            if joined_components_prefix in self._files:
-                raise FileExistsError(joined_components_prefix)
-
-            self._dirs.add(components_prefix)
-
+        self._tree.add_file(name.split('/'))
         self._files[name] = content
 
         for tag in tags:
@@ -325,14 +1824,17 @@ class SharCreator:
         dest,
         *,
         follow_symlinks=False,
-        tags_cb=None
+        tags_cb=None,
+        scan_workers=1,
+        lazy=False
     ):
         """Recursively add files from `src` directory.
 
         Scanning is performed by recursive invocation of :func:`os.scandir`.
+        Entries of each directory are processed in order of their names.
 
-        Note: directory scanning is performed at the moment of :func:`add_dir` invocation,
-        and file reading is done during :func:`render`.
+        Note: unless `lazy` is set, directory scanning is performed at the moment of
+        :func:`add_dir` invocation, and file reading is done during :func:`render`.
 
         Note: empty directories will not be created during extraction.
 
@@ -351,6 +1853,16 @@ class SharCreator:
             tags_cb (Callable[DirEntry, List[Str]], optional): callback to
               assign tags to files. Invoked during scanning. Defaults to no callback
               thus no tags. See :class:`os.DirEntry`.
+            scan_workers (int, optional): number of threads listing subdirectories concurrently,
+              which helps with slow (e.g. network) file systems. Files are still added in
+              the same deterministic order. Defaults to `1`, i.e. directories are listed
+              sequentially.
+            lazy (bool, optional): specifies whether scanning is deferred to :func:`render`,
+              where files are encoded as soon as they are found, rather than being kept
+              by this object. Each invocation of :func:`render` scans the directory anew.
+              Files of lazily added directories are emitted after all other files, and their
+              conflicts with other files are only detected by :func:`render`.
+              Not compatible with `tags_cb`. Defaults to `False`.
 
         Returns:
             `self` to allow method chaining.
@@ -360,29 +1872,42 @@ class SharCreator:
               a symlink to file, a directory, or (if enabled by `follow_symlinks`)
               a symlink to a directory.
         """
+        _check_type(scan_workers, "scan_workers", int, "int")
+        if scan_workers < 1:
+            raise ValueError("scan_workers must be positive")
+
+        if lazy:
+            if tags_cb is not None:
+                raise ValueError("tags_cb is not compatible with lazy mode")
+
+            self._lazy_dirs.append((src, dest, follow_symlinks, scan_workers))
+            return self
+
         if tags_cb is None:
             tags_cb = lambda e: []  # noqa: E731
 
-        def recurse(src, dest):
-            with _os.scandir(src) as it:
-                for entry in it:
-                    src_name = _os.path.join(src, entry.name)
-                    dest_name = _posixpath.join(dest, entry.name)
-                    if entry.is_file():
-                        self.add_file(
-                            dest_name,
-                            lambda fname=src_name: open(fname, 'rb'),
-                            tags=tags_cb(entry)
-                        )
-                    elif entry.is_dir(follow_symlinks=follow_symlinks):
-                        recurse(src_name, dest_name)
-                    else:
-                        raise ValueError("do not know how to deal with " + src_name)
-
-        recurse(src, dest)
+        for src_name, dest_name, entry in _walk_dir(src, dest, follow_symlinks, scan_workers):
+            self.add_file(
+                dest_name,
+                lambda fname=src_name: open(fname, 'rb'),
+                tags=tags_cb(entry)
+            )
 
         return self
 
+    def _iter_files(self, lazy_tree):
+        """Yield (name, content) of files to be archived: added files in sorted order,
+        followed by files of lazily added directories, scanned meanwhile. Names of the latter
+        are added to `lazy_tree`.
+        """
+        yield from sorted(self._files.items())
+
+        for src, dest, follow_symlinks, scan_workers in self._lazy_dirs:
+            for src_name, dest_name, _ in _walk_dir(src, dest, follow_symlinks, scan_workers):
+                name = _posixpath.normpath(dest_name)
+                lazy_tree.add_file(name.split('/'))
+                yield name, lambda fname=src_name: open(fname, 'rb')
+
     def _add_chunk(self, dest, chunk, order):
         _check_type(order, "order", int, "int")
         dest.append((order, chunk))
@@ -433,6 +1958,16 @@ class SharCreator:
         build_validators=None,
         extraction_verifiers=None,
         tee_to_file=True,
+        workers=1,
+        solid=False,
+        dedup=False,
+        cache=None,
+        stats=None,
+        extract_jobs=1,
+        batch_moves=False,
+        extract_in_place=False,
+        trace='full',
+        mmap=False,
         _test_tmp_dir=None,
     ):
         """Produce a shell script.
@@ -450,15 +1985,61 @@ class SharCreator:
             encoder (Encoder, optional): Instance of a class used to encode content of each
               file. Defaults to `None` which is treated
               as ``Base64Encoder(compressor=XzCompressor())``.
-              See :class:`Base64Encoder` and :class:`XzCompressor` for details.
+              See :class:`Base64Encoder`, :class:`RawEncoder` and :class:`XzCompressor` for details.
             build_validators (:obj:`list` of :obj:`BuildValidator`, optional): list of build-time
-              validator object instances.
+              validator object instances. Validators are passed the skeleton of the script,
+              with payload bodies, hashes of files and payload offsets replaced by placeholders.
               Defaults to `None` which is a shortcut for [:class:`ShellcheckValidator`].
             extraction_verifiers (:obj:`list` of `ExtractionVerifier`, optional): list of extraction-time
               verifier object instances.
-              Defaults to `None` which is a shortcut for [:class:`Md5Verifier`].
+              Defaults to `None` which is a shortcut for [:class:`Md5Verifier`]. See also
+              :class:`Sha256Verifier`, :class:`Blake2Verifier` and :class:`XxhashVerifier`.
             tee_to_file (bool, optional): specifies whether the produced script will be wrapped
               in a ``{...} 2>& | tee log`` construct. Defaults to `True`.
+            workers (int, optional): number of threads used to read, verify, compress and encode
+              files concurrently. Output is still emitted in the same deterministic order.
+              At most ``2 * workers`` encoded files are held pending at any moment.
+              Defaults to `1`, i.e. files are processed sequentially.
+            solid (bool, optional): specifies whether all files are to be packed into a single
+              tar stream, which is encoded (and compressed) as a whole and extracted with
+              a single invocation of `tar`. This improves compression of many small files and
+              saves per file extraction overhead. Files to be extracted to ``arena`` are
+              extracted in place, while other files are still moved to their destinations.
+              Not compatible with `workers`. Defaults to `False`.
+            dedup (bool, optional): specifies whether content of files is to be hashed, so that
+              each unique content is encoded only once, with duplicates being copied at
+              extraction time. Content of each file is spooled (in memory or in a temporary file)
+              while being hashed. Extraction-time verifiers still check every file.
+              Not compatible with `solid`. Defaults to `False`.
+            cache (PayloadCache, optional): cache of encoded file contents to be reused across renders.
+              Content of each file is spooled while being hashed, as with `dedup`.
+              Not compatible with `solid`. Defaults to `None`.
+            extract_jobs (int, optional): maximum number of files decoded (and decompressed)
+              concurrently by background jobs at extraction time. All jobs are waited for
+              before extracted files are verified and moved to their destinations.
+              Not compatible with `solid`. Defaults to `1`, i.e. files are extracted sequentially.
+            batch_moves (bool, optional): specifies whether files are extracted into a staging tree
+              mirroring their destinations, which is then moved in place as a whole (for files
+              to be extracted to ``arena``) or one directory at a time by ``find ... -exec mv -t``,
+              after a single ``find`` pass checking that no destination is a directory.
+              This avoids a pair of commands per file at extraction time, but requires
+              GNU ``find`` and ``mv``. Defaults to `False`.
+            extract_in_place (bool, optional): specifies whether ``arena`` and its directories
+              are created before any file is extracted, so that files to be extracted to ``arena``
+              are decoded straight to their destinations rather than to temporary files.
+              Other files are still moved to their destinations after verification.
+              Has no effect in `solid` mode, which always extracts files to ``arena`` in place.
+              Defaults to `False`.
+            trace (str, optional): tracing policy of the script. Either ``'full'``, for every command
+              to be traced (with ``set -x``), or ``'user'``, for only chunks added by :func:`add_pre`
+              and :func:`add_post` to be traced, which makes extraction of many files faster and
+              its log shorter. Defaults to ``'full'``.
+            mmap (bool, optional): specifies whether regular files of at least 1 MiB are memory
+              mapped and read as zero-copy slices of the mapping, rather than copied by `read`.
+              Note: a file truncated while being rendered makes the process crash with `SIGBUS`,
+              so only use this for files which are not modified concurrently. Defaults to `False`.
+            stats (RenderStats, optional): observer to be notified of time spent and bytes processed
+              in each phase of processing of each file. See :class:`RenderStats`. Defaults to `None`.
             _test_tmp_dir: for use by unit tests
 
         Returns:
@@ -473,6 +2054,9 @@ class SharCreator:
 
             ValidatorError: If resulting shell script does not pass build-time validation.
 
+            FileExistsError, IsADirectoryError, ValueError: If scanning of a lazily added
+                directory fails, as with :func:`add_file` and :func:`add_dir`.
+
         .. _shebang: https://en.wikipedia.org/wiki/Shebang_(Unix)
         """
         encoder = encoder or Base64Encoder(compressor=XzCompressor())
@@ -481,21 +2065,88 @@ class SharCreator:
         if extraction_verifiers is None:
             extraction_verifiers = [Md5Verifier()]
 
+        _check_type(workers, "workers", int, "int")
+        if workers < 1:
+            raise ValueError("workers must be positive")
+
+        if solid and workers != 1:
+            raise ValueError("solid mode is not compatible with workers")
+
+        if solid and (dedup or cache):
+            raise ValueError("solid mode is not compatible with dedup and cache")
+
+        _check_type(extract_jobs, "extract_jobs", int, "int")
+        if extract_jobs < 1:
+            raise ValueError("extract_jobs must be positive")
+
+        if solid and extract_jobs != 1:
+            raise ValueError("solid mode is not compatible with extract_jobs")
+
+        if trace not in ('full', 'user'):
+            raise ValueError("trace must be either 'full' or 'user'")
+
+        spool_contents = dedup or cache is not None
+
+        inline_verifiers = [i for i in extraction_verifiers if getattr(i, 'inline', False)]
+        if len(inline_verifiers) > 1:
+            raise ValueError("at most one extraction verifier may be inline")
+
+        # in solid mode, files are not extracted individually
+        inline_verifier = inline_verifiers[0] if inline_verifiers and not solid else None
+
+        binary_payload = encoder.binary_payload
+
+        if stats is not None:
+            render_start = _time.perf_counter()
+            # for subtraction of time of nested phases
+            probe_local = _threading.local()
+            render_probe = _Probe(stats, None, probe_local)
+
+            def new_probe(name):
+                return _Probe(stats, name, probe_local)
+
+            def report_render():
+                render_probe.report()
+                stats.render_phase('total', _time.perf_counter() - render_start)
+        else:
+            def new_probe(name):
+                return _NULL_PROBE
+
         with _contextlib.ExitStack() as exit_stack:
-            writers = []
+            if stats is not None:
+                # called last, once validators have finished
+                exit_stack.callback(report_render)
+
+            # e.g. stops compression threads
+            exit_stack.callback(encoder.close)
+
+            validator_writers = []
 
             for validator in build_validators:
-                writers.append(exit_stack.enter_context(validator))
+                if stats is not None:
+                    validator = _timed_validator(validator, render_probe)
+
+                validator_writers.append(exit_stack.enter_context(validator))
 
             if out_stm is None:
                 result_chunks = []
-                writers.append(lambda what: result_chunks.append(what))
+                output = result_chunks.append
             else:
-                writers.append(out_stm.write)
+                output = out_stm.write
+
+            if binary_payload:
+                # script text has to be buffered, as it needs to be patched
+                # with the offset of the payload before being output
+                payload = _Spool()
+                exit_stack.callback(payload.close)
+                text_chunks = []
+                text_output = text_chunks.append
+            else:
+                payload = None
+                text_output = output
 
-            def put(what):
-                for writer in writers:
-                    writer(what)
+            fan_out = _FanOut([text_output], validator_writers)
+            put = fan_out.write
 
             def putnl():
                 put(b"\n")
@@ -516,11 +2167,17 @@ class SharCreator:
                 if chunks:
                     put_annotation(annotation)
 
+                    if trace == 'user':
+                        putl(b'set -x')
+
                     # according to https://wiki.python.org/moin/HowTo/Sorting/#Sort_Stability_and_Complex_Sorts
                     # sorts are guaranteed to stable.
                     for _, i in sorted(chunks, key=lambda i: i[0]):
                         putl(_to_bytes(_call_if_callable(i), "chunk"))
 
+                    if trace == 'user':
+                        putl(b'set +x')
+
             put(b'#!%s\n' % _to_bytes(shebang, "shebang"))
             put_break()
             put(
@@ -534,58 +2191,378 @@ class SharCreator:
 
             put_break()
             put(
-                b'set -euxo pipefail\n'
-                b'DIR=$('
+                b'set -eu%so pipefail\n'
+                b'DIR=$(' % (b'x' if trace == 'full' else b'')
             )
 
             if _test_tmp_dir is not None:
                 put(b"TMPDIR=%s " % _shlex.quote(_test_tmp_dir).encode())
 
-            put(
-                b'mktemp -d)\n'
-                b'cd "$DIR"\n'
-            )
+            put(b'mktemp -d)\n')
+
+            if binary_payload:
+                fan_out.flush()
+                payload_offset_index = len(text_chunks)
+                put(b'TINYSHAR_PAYLOAD=%s\n' % (b' ' * 20))
+                fan_out.flush()
+                put(
+                    b'TINYSHAR_ARCHIVE="$(CDPATH=\'\' cd -- "$(dirname -- "$0")" >/dev/null && pwd)"\n'
+                    b'TINYSHAR_ARCHIVE="$TINYSHAR_ARCHIVE/$(basename -- "$0")"\n'
+                    b'tinyshar_payload() {\n'
+                    b'    # tail is expected to be killed by SIGPIPE once head has read enough\n'
+                    b'    { tail -c "+$((TINYSHAR_PAYLOAD + $1))" "$TINYSHAR_ARCHIVE" || test $? -eq 141; } \\\n'
+                    b'        | head -c "$2"\n'
+                    b'}\n'
+                )
+
+            put(b'cd "$DIR"\n')
 
             if tee_to_file:
                 putl(b'{')
 
             put_chunks(b'PRE:', self._pre_chunks)
 
-            files_map = []
-            for i, (name, content) in enumerate(sorted(self._files.items())):
-                tmp_name = b'%06d' % i
-                files_map.append((tmp_name, _shlex.quote(name).encode()))
-
-                put_annotation(b'file: %s\n' % name.encode())
-
-                with _make_reader_stm(content) as reader_stm:
-                    reader = lambda n: reader_stm.read(n)  # noqa: E731
+            def make_reader(source, tmp_name, probe):
+                reader = probe.reader('read', source)
 
+                if extraction_verifiers:
                     for verifier in extraction_verifiers:
                         reader = verifier.wrap_reader(reader, tmp_name)
 
-                    encoder.encode(tmp_name, reader, put)
+                    reader = probe.reader('verify', reader)
+
+                return reader
+
+            def tmp_path(tmp_name, name):
+                """Return the path (relative to $DIR) a file is extracted to."""
+                if extract_in_place and not name.startswith('/'):
+                    return b'arena/' + name.encode()
+                elif not batch_moves:
+                    return tmp_name
+                elif name.startswith('/'):
+                    return b'root' + name.encode()
+                else:
+                    return b'stage/' + name.encode()
+
+            def prepare(tmp_name, content, probe):
+                with _open_source(content, mmap) as source:
+                    return probe.timed('encode', encoder.prepare)(make_reader(source, tmp_name, probe), probe)
+
+            # digest of content -> tmp_path of the first file having it
+            seen = {}
+
+            def spool_content(tmp_name, content, probe):
+                """Return digest of content, and either a spool of it, or, if it is found
+                in the cache, its prepared payload. Seekable sources are hashed first,
+                and spooled (read again) only on a cache miss.
+                """
+                digest = _hashlib.sha256()
+
+                with _open_source(content, mmap) as source:
+                    reader = make_reader(source, tmp_name, probe)
+
+                    def hashing_reader(n):
+                        chunk = reader(n)
+                        digest.update(chunk)
+                        return chunk
+
+                    spool_reader = hashing_reader
+
+                    if cache is not None and source.rewind is not None:
+                        probe.timed('spool', _drain)(hashing_reader)
+                        prepared = cache._get(cache._key(encoder, digest.digest()))
+                        if prepared is not None:
+                            return digest.digest(), None, prepared
+
+                        source.rewind()
+                        spool_reader = source
+
+                    spool = _Spool()
+                    probe.timed('spool', spool.append)(spool_reader)
+
+                return digest.digest(), spool, None
+
+            def discard_spooled(spool, prepared):
+                (spool if prepared is None else prepared[1]).close()
+
+            def prepare_spooled(digest, spool, prepared, probe):
+                if prepared is not None:
+                    return prepared
+
+                with _contextlib.closing(spool):
+                    if cache is None:
+                        return probe.timed('encode', encoder.prepare)(spool.reader(), probe)
+                    else:
+                        return probe.timed('encode', cache._prepare)(encoder, digest, spool.reader(), probe)
+
+            def emit_file(probe, sink, method, data, *extra_args):
+                # method is either encoder.encode or encoder.emit
+                payload_size = payload.size if binary_payload else 0
+                probe.timed('encode', method)(
+                    sink, data, probe.writer(put), payload, *extra_args,
+                    body_writer=probe.writer(fan_out.body_writer(encoder.body_placeholder))
+                )
+
+                if binary_payload:
+                    probe.count('payload', payload.size - payload_size)
+
+                probe.report()
+
+            # with extract_jobs, originals may still be being extracted, so duplicates
+            # are copied once all jobs have finished
+            duplicates = []
+
+            def put_duplicate(original, path):
+                if extract_jobs == 1:
+                    put(b"cp %s %s\n" % (_quote(original), _quote(path)))
+                else:
+                    duplicates.append(b"cp %s %s\n" % (_quote(original), _quote(path)))
+
+            def emit_tmp_file(probe, tmp_name, path, method, data, *extra_args):
+                if extract_jobs != 1:
+                    put(b"{\n")
+
+                if inline_verifier is None:
+                    emit_file(probe, b"> %s" % _quote(path), method, data, *extra_args)
+                else:
+                    sum_fname = tmp_name + b'.sum'
+                    emit_file(probe, inline_verifier.inline_sink(path, sum_fname), method, data, *extra_args)
+                    inline_verifier.render_inline(
+                        path, put, sum_fname=sum_fname, body_writer=fan_out.body_writer(b'0')
+                    )
+
+                if extract_jobs != 1:
+                    put(b"} &\ntinyshar_job_started\n")
+
+            # list of (quoted path relative to arena, quoted target name) of files
+            # to be moved to their destinations after extraction
+            files_map = []
+            # with batch_moves or extract_in_place, directories created in the staging tree
+            # or in arena, and with batch_moves, absolute directories files are to be moved to
+            staged_dirs = {b'stage', b'arena'}
+            move_dirs = set()
+
+            def add_move_dir(name):
+                move_dirs.add(_posixpath.dirname(name))
+
+            def put_mkdirs(paths):
+                # a fork per a few dozens of directories, rather than per directory
+                paths = iter(paths)
+                for batch in iter(lambda: list(_itertools.islice(paths, 64)), []):
+                    put(b"mkdir -p %s\n" % b' '.join(_quote(i) for i in batch))
+
+            def begin_file(path, name):
+                put_annotation(b'file: %s\n' % name.encode().replace(b'\n', b'\\n'))
+
+                if name.startswith('/') or not extract_in_place:
+                    if not batch_moves:
+                        files_map.append((b'../' + path, _shlex.quote(name).encode()))
+                        return
+
+                    if name.startswith('/'):
+                        add_move_dir(name)
+                elif name in self._files:
+                    # directories of arena have been created up front, except for
+                    # those of lazily added directories
+                    return
+
+                staged_dir = _posixpath.dirname(path)
+                if staged_dir not in staged_dirs:
+                    staged_dirs.add(staged_dir)
+                    put(b"mkdir -p %s\n" % _quote(staged_dir))
+
+            # names of files of lazily added directories
+            lazy_tree = _PathTree(self._tree)
+            entries = self._iter_files(lazy_tree)
+            exit_stack.callback(entries.close)
+            # lazily added directories may turn out to contain no files
+            first_entry = list(_itertools.islice(entries, 1))
+            entries = _itertools.chain(first_entry, entries)
+
+            def solid_chunks():
+                for name, content in entries:
+                    if name.startswith('/'):
+                        member = 'root' + name
+                        if batch_moves:
+                            add_move_dir(name)
+                        else:
+                            files_map.append((_shlex.quote('../' + member).encode(), _shlex.quote(name).encode()))
+                    else:
+                        member = 'arena/' + name
+
+                    data = _Spool()
+                    probe = new_probe(name)
+
+                    with _open_source(content, mmap) as source:
+                        probe.timed('spool', data.append)(make_reader(source, member.encode(), probe))
+
+                    probe.report()
+
+                    info = _tarfile.TarInfo(member)
+                    info.size = data.size
+                    info.mode = 0o644
+                    yield info.tobuf(_tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+                    yield from data.chunks()
+                    data.close()
+                    yield b'\0' * (-info.size % _tarfile.BLOCKSIZE)
+
+                yield b'\0' * (2 * _tarfile.BLOCKSIZE)
+
+            files = enumerate(entries)
+
+            if extract_jobs != 1:
+                # pids of jobs are kept in a FIFO of numbered variables (rather than relying on
+                # `wait -n` of newer bash versions), and the oldest job is waited for
+                # once the limit is reached
+                put(
+                    b'TINYSHAR_JOBS_STARTED=0\n'
+                    b'TINYSHAR_JOBS_DONE=0\n'
+                    b'tinyshar_job_wait() {\n'
+                    b'    eval "wait \\"\\$tinyshar_job_$TINYSHAR_JOBS_DONE\\""\n'
+                    b'    TINYSHAR_JOBS_DONE=$((TINYSHAR_JOBS_DONE + 1))\n'
+                    b'}\n'
+                    b'tinyshar_job_started() {\n'
+                    b'    eval "tinyshar_job_$TINYSHAR_JOBS_STARTED=$!"\n'
+                    b'    TINYSHAR_JOBS_STARTED=$((TINYSHAR_JOBS_STARTED + 1))\n'
+                    b'    if [ $((TINYSHAR_JOBS_STARTED - TINYSHAR_JOBS_DONE)) -ge %d ]; then\n'
+                    b'        tinyshar_job_wait\n'
+                    b'    fi\n'
+                    b'}\n' % extract_jobs
+                )
+
+            if extract_in_place and not solid:
+                put_annotation(b'arena:\n')
+                put(b'mkdir arena\n')
+                put_mkdirs(b'arena/' + '/'.join(i).encode() for i in self._tree.leaf_dirs() if i[0] != '')
+            elif batch_moves and not solid:
+                # the staging tree of files to be extracted to arena
+                put(b'mkdir stage\n')
+
+            if solid:
+                put_annotation(b'files (solid):\n')
+                put(b'mkdir arena\n')
+
+                if first_entry:
+                    probe = new_probe('<solid>')
+                    reader = probe.reader('spool', _make_chunks_reader(solid_chunks()))
+                    emit_file(probe, b'| tar -xmof -', encoder.encode, reader, probe)
+            elif workers == 1:
+                for i, (name, content) in files:
+                    tmp_name = b'%06d' % i
+                    path = tmp_path(tmp_name, name)
+                    begin_file(path, name)
+                    probe = new_probe(name)
+
+                    if spool_contents:
+                        digest, spool, prepared = spool_content(path, content, probe)
+                        original = seen.setdefault(digest, path) if dedup else path
+
+                        if original == path:
+                            prepared = prepare_spooled(digest, spool, prepared, probe)
+                            emit_tmp_file(probe, tmp_name, path, encoder.emit, prepared)
+                        else:
+                            discard_spooled(spool, prepared)
+                            put_duplicate(original, path)
+                            probe.report()
+                    else:
+                        with _open_source(content, mmap) as source:
+                            reader = make_reader(source, path, probe)
+                            emit_tmp_file(probe, tmp_name, path, encoder.encode, reader, probe)
+            else:
+                # files are prepared concurrently, but emitted strictly in order.
+                # Number of prepared, but not yet emitted files is bounded.
+                pending = _collections.deque()
+                executor = exit_stack.enter_context(_futures.ThreadPoolExecutor(max_workers=workers))
+                exit_stack.callback(lambda: [i.future.cancel() for i in pending])
+
+                while True:
+                    for i, (name, content) in _itertools.islice(files, 2 * workers - len(pending)):
+                        tmp_name = b'%06d' % i
+                        path = tmp_path(tmp_name, name)
+                        job = spool_content if spool_contents else prepare
+                        probe = new_probe(name)
+                        future = executor.submit(job, path, content, probe)
+                        pending.append(_PendingFile(tmp_name, name, path, probe, future, not spool_contents))
+
+                    if not pending:
+                        break
+
+                    # duplicates are identified strictly in order to keep the output deterministic,
+                    # and unique files are submitted for encoding as soon as possible
+                    for n, entry in enumerate(pending):
+                        if entry.decided:
+                            continue
+
+                        if n and not entry.future.done():
+                            break
+
+                        digest, spool, prepared = entry.future.result()
+                        original = seen.setdefault(digest, entry.path) if dedup else entry.path
+                        if original == entry.path:
+                            entry.future = executor.submit(prepare_spooled, digest, spool, prepared, entry.probe)
+                        else:
+                            discard_spooled(spool, prepared)
+                            entry.original = original
+
+                        entry.decided = True
+
+                    entry = pending.popleft()
+                    begin_file(entry.path, entry.name)
+
+                    if entry.original is None:
+                        emit_tmp_file(entry.probe, entry.tmp_name, entry.path, encoder.emit, entry.future.result())
+                    else:
+                        put_duplicate(entry.original, entry.path)
+                        entry.probe.report()
+
+            if extract_jobs != 1:
+                put_break()
+                put(
+                    b'while [ "$TINYSHAR_JOBS_DONE" -lt "$TINYSHAR_JOBS_STARTED" ]; do\n'
+                    b'    tinyshar_job_wait\n'
+                    b'done\n'
+                )
+
+                for i in duplicates:
+                    put(i)
 
-            if files_map:
+            if first_entry:
                 put_annotation(b"verification:\n")
 
                 for verifier in extraction_verifiers:
-                    verifier.render(put)
+                    verifier.render(put, new_body_writer=fan_out.body_writer)
 
             put_break()
-            put(
-                b'mkdir arena\n'
-                b'cd arena\n'
-            )
 
-            for i in sorted(self._dirs - set(j[:d] for j in self._dirs for d in range(1, len(j)))):
-                put(b'mkdir -p %s\n' % _shlex.quote('/'.join(i)).encode())
+            if not (solid or extract_in_place):
+                put(b'mv stage arena\n' if batch_moves else b'mkdir arena\n')
 
-            for tmp_name, quoted_target in files_map:
+            put(b'cd arena\n')
+
+            # groupby drops directories present in both trees
+            for i, _ in _itertools.groupby(_heapq.merge(self._tree.leaf_dirs(), lazy_tree.leaf_dirs())):
+                # in solid mode, directories in arena are created by tar, with batch_moves,
+                # they are a part of the staging tree, and with extract_in_place, they exist already
+                if not (solid or batch_moves or extract_in_place) or i[0] == '':
+                    put(b'mkdir -p %s\n' % _shlex.quote('/'.join(i)).encode())
+
+            if move_dirs:
+                put(
+                    b"find ../root -type f -exec sh -c "
+                    b"'for f; do test ! -d \"${f#../root}\" || exit 1; done' sh {} +\n"
+                )
+
+                for i in sorted(move_dirs):
+                    put(b"find %s -mindepth 1 -maxdepth 1 -type f -exec mv -f -t %s {} +\n" % (
+                        _shlex.quote('../root' + i).encode(),
+                        _shlex.quote(i).encode()
+                    ))
+
+            for quoted_src, quoted_target in files_map:
                 put(b"test '!' -d %s\n" % quoted_target)
 
-            for tmp_name, quoted_target in files_map:
-                put(b"mv -f ../%s %s\n" % (tmp_name, quoted_target))
+            for quoted_src, quoted_target in files_map:
+                put(b"mv -f %s %s\n" % (quoted_src, quoted_target))
 
             put_chunks(b'POST:', self._post_chunks)
 
@@ -601,5 +2578,80 @@ class SharCreator:
 
             put_break()
 
+            if binary_payload:
+                put(b"exit\n")
+
+            fan_out.flush()
+
+            if binary_payload:
+                text_size = sum(len(i) for i in text_chunks)
+                text_chunks[payload_offset_index] = b'TINYSHAR_PAYLOAD=%-20d\n' % (text_size + 1)
+
+                for i in text_chunks:
+                    output(i)
+
+                if out_stm is None:
+                    payload.copy_to(output)
+                else:
+                    payload.send_to(out_stm)
+
+            if cache is not None:
+                cache._trim()
+
             if out_stm is None:
                 return result_chunks
+
+    def render_iter(self, *, chunk_size=1024 * 1024, max_memory=16 * 1024 * 1024, spill=False, **kwargs):
+        """Render the archive, yielding it in chunks as it is being produced.
+
+        Rendering is performed by a background thread, so that the consumer
+        (e.g. an upload) and rendering run concurrently. Unlike :func:`render` without
+        `out_stm`, memory used for the rendered output is bounded, so archives larger
+        than available memory can be produced.
+
+        If the generator is closed before being exhausted, rendering is aborted.
+
+        Args:
+            chunk_size (int, optional): minimum size of yielded chunks (except for the last one).
+              Defaults to 1 MiB.
+            max_memory (int, optional): maximum number of bytes rendered, but not yet consumed,
+              to be held in memory. Defaults to 16 MiB.
+            spill (bool, optional): specifies what happens when the consumer lags behind
+              by more than `max_memory`: if `False`, rendering waits for the consumer; if `True`,
+              rendered data is spilled to a temporary file, so rendering never waits.
+              Defaults to `False`.
+            **kwargs: arguments of :func:`render`, except for `out_stm`.
+
+        Yields:
+            bytes: consecutive chunks of the rendered archive.
+
+        Raises:
+            Same exceptions as :func:`render`.
+        """
+        _check_type(chunk_size, "chunk_size", int, "int")
+        _check_type(max_memory, "max_memory", int, "int")
+
+        if 'out_stm' in kwargs:
+            raise TypeError("render_iter does not accept out_stm")
+
+        channel = _Channel(max_memory, spill)
+        out_stm = _ChunkWriter(channel.put, chunk_size)
+
+        def produce():
+            try:
+                self.render(out_stm=out_stm, **kwargs)
+                out_stm.flush()
+            except BaseException as e:
+                channel.finish(e)
+            else:
+                channel.finish()
+
+        thread = _threading.Thread(target=produce, daemon=True)
+        thread.start()
+
+        try:
+            for chunk in iter(channel.get, None):
+                yield chunk
+        finally:
+            channel.close()
+            thread.join()
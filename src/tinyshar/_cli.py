@@ -17,6 +17,60 @@ def _funny_split(s):
     return s[1:].split(s[0]) if s else []
 
 
+def _given(**kwargs):
+    """Return `kwargs` without those of options which were not given."""
+    return {k: v for k, v in kwargs.items() if v is not None}
+
+
+_COMPRESSORS = {
+    'xz': lambda args, level: tinyshar.XzCompressor(
+        **_given(preset=level, threads=args.xz_threads, block_size=args.xz_block_size)
+    ),
+    'gzip': lambda args, level: tinyshar.GzipCompressor(**({} if level is None else dict(level=level))),
+    'zstd': lambda args, level: tinyshar.ZstdCompressor(**_given(level=level, threads=args.zstd_threads)),
+}
+
+
+_VERIFIERS = {
+    'md5': tinyshar.Md5Verifier,
+    'sha256': tinyshar.Sha256Verifier,
+    'blake2': tinyshar.Blake2Verifier,
+    'xxhash': tinyshar.XxhashVerifier,
+    'none': None,
+}
+
+
+def _make_compressor(parser, args):
+    spec = args.compress or ('xz' if args.C else None)
+    if spec is None:
+        return None
+
+    algo, _, level = spec.partition(':')
+
+    if algo not in _COMPRESSORS:
+        parser.error("unknown compression algorithm: %s" % algo)
+
+    if level:
+        try:
+            level = int(level)
+        except ValueError:
+            parser.error("bad compression level: %s" % level)
+    else:
+        level = None
+
+    return _COMPRESSORS[algo](args, level)
+
+
+def _make_cache(args):
+    if not args.cache_dir:
+        return None
+
+    if args.cache_size is None:
+        return tinyshar.PayloadCache(args.cache_dir)
+
+    return tinyshar.PayloadCache(args.cache_dir, max_size=args.cache_size)
+
+
 def main(argv=None):
     parser = argparse.ArgumentParser(
         description="create a self-extracting shell archive",
@@ -75,11 +129,155 @@ def main(argv=None):
         default=False,
         help="follow directory symlinks"
     )
+    parser.add_argument(
+        "--scan-jobs",
+        metavar="<n>",
+        type=int,
+        default=1,
+        help="number of directories to be listed concurrently. Defaults to 1"
+    )
+    parser.add_argument(
+        "--lazy-scan",
+        action='store_true',
+        default=False,
+        help="scan directories while rendering, instead of beforehand"
+    )
     parser.add_argument(
         "-C",
         action='store_true',
         default=False,
-        help="enable compression"
+        help="enable compression (with xz, unless --compress is given)"
+    )
+    parser.add_argument(
+        "--compress",
+        metavar="<algo>[:<level>]",
+        default=None,
+        help="enable compression with <algo>, one of: %s" % ', '.join(sorted(_COMPRESSORS))
+    )
+    parser.add_argument(
+        "--adaptive",
+        action='store_true',
+        default=False,
+        help="do not compress files which are found to be incompressible by compressing a sample"
+    )
+    parser.add_argument(
+        "--xz-threads",
+        metavar="<n>",
+        type=int,
+        default=None,
+        help="number of threads used for xz compression (0 means number of CPUs). Defaults to 1"
+    )
+    parser.add_argument(
+        "--zstd-threads",
+        metavar="<n>",
+        type=int,
+        default=None,
+        help="number of threads used for zstd compression (0 means number of CPUs). Defaults to 1"
+    )
+    parser.add_argument(
+        "--xz-block-size",
+        metavar="<bytes>",
+        type=int,
+        default=None,
+        help="size of independently compressed blocks when using multiple threads. Defaults to 16 MiB"
+    )
+    parser.add_argument(
+        "-j",
+        metavar="<n>",
+        type=int,
+        default=1,
+        help="number of files to be read and encoded concurrently. Defaults to 1"
+    )
+    parser.add_argument(
+        "--extract-jobs",
+        metavar="<n>",
+        type=int,
+        default=1,
+        help="number of files to be decoded concurrently at extraction time. Defaults to 1"
+    )
+    parser.add_argument(
+        "--batch-moves",
+        action='store_true',
+        default=False,
+        help="move extracted files to their destinations a directory at a time. Requires GNU find and mv"
+    )
+    parser.add_argument(
+        "--in-place",
+        action='store_true',
+        default=False,
+        help="decode files straight to their destinations in arena, rather than to temporary files"
+    )
+    parser.add_argument(
+        "--solid",
+        action='store_true',
+        default=False,
+        help="pack all files into a single tar stream"
+    )
+    parser.add_argument(
+        "--dedup",
+        action='store_true',
+        default=False,
+        help="encode files with identical content only once"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="<dir>",
+        help="directory to cache encoded files in across invocations"
+    )
+    parser.add_argument(
+        "--cache-size",
+        metavar="<bytes>",
+        type=int,
+        default=None,
+        help="maximum size of cache. Defaults to 1 GiB"
+    )
+    parser.add_argument(
+        "--shellcheck-cache-dir",
+        metavar="<dir>",
+        help="directory to cache successful shellcheck validation results in across invocations"
+    )
+    parser.add_argument(
+        "--raw",
+        action='store_true',
+        default=False,
+        help="append raw file data after the script instead of embedding it base64 encoded"
+    )
+    parser.add_argument(
+        "--verifier",
+        choices=sorted(_VERIFIERS),
+        default='md5',
+        help="hash used to verify extracted files. Defaults to md5"
+    )
+    parser.add_argument(
+        "--verify-jobs",
+        metavar="<n>",
+        type=int,
+        default=None,
+        help="number of parallel jobs verifying extracted files. Defaults to 1"
+    )
+    parser.add_argument(
+        "--inline-verify",
+        action='store_true',
+        default=False,
+        help="hash files while they are being extracted, instead of reading them back afterwards"
+    )
+    parser.add_argument(
+        "--mmap",
+        action='store_true',
+        default=False,
+        help="memory map large files instead of reading them. Files must not be truncated meanwhile"
+    )
+    parser.add_argument(
+        "--stats",
+        action='store_true',
+        default=False,
+        help="print a summary of time spent in each phase and the slowest files to stderr"
+    )
+    parser.add_argument(
+        "--trace",
+        choices=['full', 'user'],
+        default='full',
+        help="commands traced at extraction time: all, or only those given with -p and -c. Defaults to full"
     )
     parser.add_argument(
         "--no-shellcheck",
@@ -93,14 +291,38 @@ def main(argv=None):
     )
 
     args = parser.parse_args(args=argv)
+    compressor = _make_compressor(parser, args)
+    verifier = _VERIFIERS[args.verifier]
+
+    if args.adaptive and compressor is None:
+        parser.error("--adaptive requires -C or --compress")
+
+    if (args.xz_threads is not None or args.xz_block_size is not None) and \
+            not isinstance(compressor, tinyshar.XzCompressor):
+        parser.error("--xz-threads and --xz-block-size require xz compression")
+
+    if args.zstd_threads is not None and not isinstance(compressor, tinyshar.ZstdCompressor):
+        parser.error("--zstd-threads requires zstd compression")
+
+    if args.cache_size is not None and not args.cache_dir:
+        parser.error("--cache-size requires --cache-dir")
+
+    if args.verify_jobs is not None and verifier is None:
+        parser.error("--verify-jobs requires a verifier")
+
+    if args.inline_verify and verifier is None:
+        parser.error("--inline-verify requires a verifier")
+
+    if compressor is not None and args.adaptive:
+        compressor = tinyshar.AdaptiveCompressor(compressor)
 
     shar = tinyshar.SharCreator()
 
     for i in args.a:
-        shar.add_dir(i, '/', follow_symlinks=args.L)
+        shar.add_dir(i, '/', follow_symlinks=args.L, scan_workers=args.scan_jobs, lazy=args.lazy_scan)
 
     for i in args.r:
-        shar.add_dir(i, '', follow_symlinks=args.L)
+        shar.add_dir(i, '', follow_symlinks=args.L, scan_workers=args.scan_jobs, lazy=args.lazy_scan)
 
     for i in args.p:
         shar.add_pre(i)
@@ -121,6 +343,8 @@ def main(argv=None):
     for i in args.c:
         shar.add_post(i)
 
+    stats = tinyshar.RenderStats() if args.stats else None
+
     with contextlib.ExitStack() as exit_stack:
         if args.o:
             out_stm = exit_stack.enter_context(open(args.o, 'wb'))
@@ -130,11 +354,38 @@ def main(argv=None):
         try:
             shar.render(
                 out_stm=out_stm,
-                build_validators=[] if args.no_shellcheck else [tinyshar.ShellcheckValidator()],
-                encoder=tinyshar.Base64Encoder(compressor=tinyshar.XzCompressor() if args.C else None),
-                tee_to_file=not args.no_tee
+                build_validators=[] if args.no_shellcheck else [
+                    tinyshar.ShellcheckValidator(cache_dir=args.shellcheck_cache_dir)
+                ],
+                extraction_verifiers=[] if verifier is None else [
+                    verifier(inline=args.inline_verify, **_given(jobs=args.verify_jobs))
+                ],
+                encoder=(tinyshar.RawEncoder if args.raw else tinyshar.Base64Encoder)(compressor=compressor),
+                tee_to_file=not args.no_tee,
+                workers=args.j,
+                solid=args.solid,
+                dedup=args.dedup,
+                cache=_make_cache(args),
+                stats=stats,
+                extract_jobs=args.extract_jobs,
+                batch_moves=args.batch_moves,
+                extract_in_place=args.in_place,
+                trace=args.trace,
+                mmap=args.mmap
             )
         except tinyshar.ValidatorError as e:
             sys.stderr.buffer.write(e.args[0].encode())
             sys.stderr.buffer.write(e.args[1])
             sys.exit()
+
+    if stats is not None:
+        sys.stderr.write(stats.summary())
+
+        if isinstance(compressor, tinyshar.AdaptiveCompressor):
+            sys.stderr.write(
+                "\nadaptive compression: %d files compressed, %d skipped, estimated %.3f seconds saved\n" % (
+                    compressor.files_compressed,
+                    compressor.files_skipped,
+                    compressor.estimated_seconds_saved,
+                )
+            )
@@ -16,7 +16,7 @@ def bump(ctx, part='patch'):
 
 @task
 def check(ctx):
-    ctx.run("flake8 --max-line-length=120 setup.py tasks.py src tests")
+    ctx.run("flake8 --max-line-length=120 setup.py tasks.py src tests benchmarks")
 
 
 @task
@@ -29,6 +29,11 @@ def test(ctx):
     ctx.run("tox")
 
 
+@task
+def bench(ctx, output='reports/bench.json', scale=1.0):
+    ctx.run("python benchmarks/render.py -o %s --scale %s" % (output, scale))
+
+
 @task
 def docs(ctx):
     ctx.run("sphinx-build docs/source docs/build")
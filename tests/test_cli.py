@@ -1,7 +1,9 @@
+import importlib.util
 import pytest
 from tinyshar._cli import main
 import subprocess
 import os
+import shutil
 from contextlib import contextmanager
 
 
@@ -14,6 +16,41 @@ def test_validation_error():
         main(['-p', '"'])
 
 
+@pytest.mark.parametrize('opt', ['bogus', 'xz:x'])
+def test_bad_compression(opt):
+    with pytest.raises(SystemExit):
+        main(['--compress', opt])
+
+
+@pytest.mark.parametrize('opts', [
+    ['--adaptive'],
+    ['--cache-size', '1000'],
+    ['--inline-verify', '--verifier', 'none'],
+    ['--xz-threads', '2'],
+    ['--compress', 'gzip', '--xz-block-size', '1000'],
+    ['-C', '--zstd-threads', '2'],
+    ['--verify-jobs', '2', '--verifier', 'none'],
+])
+def test_option_requires(opts, capsys):
+    with pytest.raises(SystemExit):
+        main(opts)
+
+    assert "require" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('extra_opts', [[], ['-C', '--adaptive']])
+def test_stats(tmpdir, capfd, extra_opts):
+    (tmpdir / "arena" / "file1").write_binary(b"text1", ensure=True)
+
+    main(["-o", str(tmpdir / "script.sh"), "-r", str(tmpdir / "arena"), "--stats"] + extra_opts)
+
+    captured = capfd.readouterr()
+    assert captured.out == ""
+    assert "slowest files:" in captured.err
+    assert "file1" in captured.err
+    assert ("adaptive compression:" in captured.err) == bool(extra_opts)
+
+
 def test_fail_due_symlink(tmpdir, monkeypatch):
     arena_dir = tmpdir / "arena"
     arena_dir.mkdir()
@@ -61,8 +98,47 @@ def test_fail_due_symlink(tmpdir, monkeypatch):
     assert NAME in str(e.value)
 
 
-@pytest.mark.parametrize('extra_opts', [[], ['-C']])
+@pytest.mark.parametrize('extra_opts', [
+    [], ['-C'], ['--raw'], ['--raw', '-C'],
+    ['-C', '--xz-threads', '2', '--xz-block-size', '2'],
+    ['-C', '-j', '3'],
+    ['-C', '--solid'],
+    ['-C', '--dedup', '-j', '2'],
+    ['-C', '--cache-dir', '{tmpdir}/cache', '--cache-size', '1000000'],
+    ['--cache-dir', '{tmpdir}/cache'],
+    ['--shellcheck-cache-dir', '{tmpdir}/shellcheck-cache'],
+    ['--verifier', 'sha256', '--verify-jobs', '3'],
+    ['--verifier', 'blake2', '--raw'],
+    ['-C', '--inline-verify', '--dedup'],
+    ['-C', '--extract-jobs', '2', '--raw', '--inline-verify'],
+    pytest.param(
+        ['--verifier', 'xxhash'],
+        marks=pytest.mark.skipif(
+            importlib.util.find_spec('xxhash') is None or shutil.which('xxhsum') is None,
+            reason="xxhash or xxhsum tool is not installed"
+        )
+    ),
+    ['--verifier', 'none'],
+    ['--scan-jobs', '3'],
+    ['--mmap', '-j', '2'],
+    ['--batch-moves', '--dedup'],
+    ['--batch-moves', '--solid'],
+    ['--in-place', '--batch-moves', '--extract-jobs', '2'],
+    ['--trace', 'user', '--batch-moves'],
+    ['--lazy-scan', '--scan-jobs', '2', '-j', '2'],
+    ['--compress', 'xz:1'], ['-CL', '--compress', 'xz:1'],
+    ['--compress', 'gzip'],
+    ['-C', '--adaptive'],
+    ['--compress', 'gzip:9', '--raw', '--adaptive'],
+    pytest.param(
+        ['--compress', 'zstd:19', '--zstd-threads', '2'],
+        marks=pytest.mark.skipif(shutil.which('zstd') is None, reason="zstd tool is not installed")
+    ),
+])
 def test_all(tmpdir, run_wrapper, capfd, extra_opts):
+    if any(i.startswith('zstd') for i in extra_opts):
+        pytest.importorskip('zstandard')
+
     root_dir = tmpdir / "root"
     # note: we assume that tmpdir is on C: drive on Windows
     root_root_dir = root_dir / os.path.splitdrive(tmpdir)[1] / "root_out"
@@ -94,7 +170,7 @@ def test_all(tmpdir, run_wrapper, capfd, extra_opts):
         "-f", ";%s;empty file;600" % os.path.devnull,
         "-f", ";%s;" % file3_path,
         "-f", ";%s;./" % file4_path,
-    ] + extra_opts)
+    ] + [i.format(tmpdir=tmpdir) for i in extra_opts])
 
     captured = capfd.readouterr()
     assert captured.out == ""
@@ -1,7 +1,16 @@
+import base64
+import contextlib
+import errno
+import gzip
+import importlib.util
+import io
+import lzma
 import os
 import pytest
+import shutil
 import tinyshar
 import subprocess
+import threading
 import filecmp
 
 
@@ -41,6 +50,17 @@ def run(tmpdir, shar, run_wrapper):
             cb_params={},
             tee_to_file=True,
             encoder=None,
+            workers=1,
+            solid=False,
+            dedup=False,
+            cache=None,
+            stats=None,
+            extraction_verifiers=None,
+            extract_jobs=1,
+            batch_moves=False,
+            extract_in_place=False,
+            trace='full',
+            mmap=False,
             patch_cb=None
         ):
             # __tracebackhide__ = True
@@ -60,6 +80,17 @@ def run(tmpdir, shar, run_wrapper):
                 render_opts = dict(
                     tee_to_file=tee_to_file,
                     encoder=encoder,
+                    workers=workers,
+                    solid=solid,
+                    dedup=dedup,
+                    cache=cache,
+                    stats=stats,
+                    extraction_verifiers=extraction_verifiers,
+                    extract_jobs=extract_jobs,
+                    batch_moves=batch_moves,
+                    extract_in_place=extract_in_place,
+                    trace=trace,
+                    mmap=mmap,
                     _test_tmp_dir=str(tmp_dir),
                     header=[
                         'Generated by test_lib.py...',
@@ -83,7 +114,10 @@ def run(tmpdir, shar, run_wrapper):
                 rendered = script.read_binary()
 
             assert rendered.startswith(b'#!')
-            assert rendered.endswith(b'#############\n')
+            if encoder is not None and encoder.binary_payload:
+                assert b'#############\nexit\n' in rendered
+            else:
+                assert rendered.endswith(b'#############\n')
 
             os.chmod(script_fname, 0o500)
 
@@ -95,6 +129,8 @@ def run(tmpdir, shar, run_wrapper):
             )
 
             assert cp.returncode in expect_returncode
+            self.stdout = cp.stdout
+            self.stderr = cp.stderr
             tmp_list = tmp_dir.listdir()
             assert len(tmp_list) == (1 if cp.returncode else 0)
 
@@ -121,8 +157,8 @@ def cmpdirs(tmpdir, shar, run):
         d.mkdir()
         dir_n += 1
 
-        def pre_run_cb(tags_cb=None, **kw):
-            shar.add_dir(str(d), dest, tags_cb=tags_cb)
+        def pre_run_cb(tags_cb=None, add_dir_kw={}, **kw):
+            shar.add_dir(str(d), dest, tags_cb=tags_cb, **add_dir_kw)
 
         def post_run_cb(expect_files=True, **kw):
             if os.path.isabs(dest):
@@ -180,6 +216,7 @@ def test_chaining(shar):
         None,
         [tinyshar.Md5Verifier()],
         [tinyshar.Md5Verifier(), tinyshar.Md5Verifier()],
+        [tinyshar.Sha256Verifier(), tinyshar.Blake2Verifier()],
     ]
 )
 def test_files(shar, extraction_verifiers):
@@ -190,6 +227,305 @@ def test_files(shar, extraction_verifiers):
     b''.join(shar.render(extraction_verifiers=extraction_verifiers))
 
 
+def test_files_xxhash(shar):
+    pytest.importorskip('xxhash')
+    shar.add_file("one", b"abc" * 10)
+
+    assert b'xxhsum' in b''.join(shar.render(extraction_verifiers=[tinyshar.XxhashVerifier()]))
+
+
+@pytest.mark.parametrize('jobs', [1, 2, 10])
+@pytest.mark.parametrize('corrupt', [False, True])
+@pytest.mark.parametrize('verifier', [
+    'Md5Verifier',
+    'Sha256Verifier',
+    'Blake2Verifier',
+    pytest.param(
+        'XxhashVerifier',
+        marks=pytest.mark.skipif(
+            importlib.util.find_spec('xxhash') is None or shutil.which('xxhsum') is None,
+            reason="xxhash or xxhsum tool is not installed"
+        )
+    ),
+])
+def test_verifiers(shar, run, verifier, corrupt, jobs):
+    class Verifier(getattr(tinyshar, verifier)):
+        def render(self, writer, **kwargs):
+            if corrupt:
+                fname, digest = self.hashes[0]
+                self.hashes[0] = (fname, digest[:-1] + (b'1' if digest.endswith(b'0') else b'0'))
+
+            super().render(writer, **kwargs)
+
+    shar.add_file("one", "1")
+    shar.add_file("back\\slash", "x")
+    shar.add_file("d/new\nline", "y" * 100000)
+    run(extraction_verifiers=[Verifier(jobs=jobs)], expect_returncode=[1] if corrupt else [0])
+
+
+@pytest.mark.parametrize('corrupt', [False, True])
+@pytest.mark.parametrize('kw, checked_after', [
+    (dict(), 0),
+    (dict(encoder=tinyshar.RawEncoder(compressor=tinyshar.XzCompressor())), 0),
+    (dict(workers=2), 0),
+    (dict(dedup=True), 1),
+    (dict(dedup=True, workers=2), 1),
+    (dict(solid=True), 4),
+    (dict(extract_jobs=2), 0),
+    (dict(extract_jobs=3, dedup=True, workers=2), 1),
+    (dict(batch_moves=True, dedup=True), 1),
+    (dict(batch_moves=True, solid=True), 4),
+    (dict(extract_in_place=True, dedup=True, extract_jobs=2), 1),
+])
+def test_inline_verifier(shar, run, kw, checked_after, corrupt):
+    class Verifier(tinyshar.Sha256Verifier):
+        corrupted = False
+
+        def _corrupt(self):
+            if corrupt and not self.corrupted:
+                self.corrupted = True
+                fname, digest = self.hashes[0]
+                digest = digest[:-1] + (b'1' if digest.endswith(b'0') else b'0')
+                self._digests[fname] = digest
+                self.hashes[0] = (fname, digest)
+
+        def render_inline(self, fname, writer, **kwargs):
+            self._corrupt()
+            super().render_inline(fname, writer, **kwargs)
+
+        def render(self, writer, **kwargs):
+            self._corrupt()
+            super().render(writer, **kwargs)
+
+    verifier = Verifier(inline=True)
+    names = ["back\\slash", "d/new\nline", "dup", "one"]
+    for i in names:
+        shar.add_file(i, ("one" if i == "dup" else i) * 1000)
+
+    def check(**kw):
+        for i in names:
+            assert (run.arena_dir / i).read_text("utf-8") == ("one" if i == "dup" else i) * 1000
+
+    if not corrupt:
+        run.add_post(check)
+        shar.add_post("false")
+
+    run(extraction_verifiers=[verifier, tinyshar.Md5Verifier()], expect_returncode=[1], **kw)
+    assert len(verifier._verified) == 4 - checked_after
+
+
+def test_inline_verifiers_bad(shar):
+    with pytest.raises(ValueError):
+        shar.render(extraction_verifiers=[tinyshar.Md5Verifier(inline=True), tinyshar.Sha256Verifier(inline=True)])
+
+
+def test_verifier_jobs(shar):
+    for i in range(10):
+        shar.add_file("f%d" % i, "x" * (10 ** (i % 5)))
+
+    verifier = tinyshar.Md5Verifier(jobs=3)
+    rendered = b''.join(shar.render(extraction_verifiers=[verifier]))
+    assert rendered.count(b"md5sum -c << '_END_' &\n") == 3
+    # no arrays, which are not available in POSIX shells
+    assert b"[@]" not in rendered
+    assert rendered.count(b'wait "$tinyshar_pid_') == 3
+    assert [sorted(i) for i in verifier._shards(verifier.hashes, 3)] == [
+        [(b'%06d' % i, verifier.hashes[i][1]) for i in j] for j in [[4], [9], [0, 1, 2, 3, 5, 6, 7, 8]]
+    ]
+
+
+@pytest.mark.parametrize('dedup', [False, True])
+@pytest.mark.parametrize('inline', [False, True])
+@pytest.mark.parametrize('jobs', [2, 5])
+def test_verifier_jobs_empty_files(shar, run, dedup, inline, jobs):
+    # empty files must not all end up in a single shard, nor shards be left empty
+    shar.add_file("__init__.py", "")
+    shar.add_file("py.typed", "")
+    shar.add_file("data", "x")
+    shar.add_file("data2", "x")
+    run(extraction_verifiers=[tinyshar.Md5Verifier(jobs=jobs, inline=inline)], dedup=dedup)
+
+
+@pytest.mark.parametrize('jobs', [0, 'x'])
+def test_verifier_bad_jobs(jobs):
+    with pytest.raises((TypeError, ValueError)):
+        tinyshar.Md5Verifier(jobs=jobs)
+
+
+@pytest.mark.skipif(shutil.which('zstd') is None, reason="zstd tool is not installed")
+@pytest.mark.parametrize('threads', [1, 3])
+@pytest.mark.parametrize('encoder', [tinyshar.Base64Encoder, tinyshar.RawEncoder])
+def test_zstd(shar, run, somefiles, encoder, threads):
+    pytest.importorskip('zstandard')
+    run(encoder=encoder(compressor=tinyshar.ZstdCompressor(level=5, threads=threads)))
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+@pytest.mark.parametrize('encoder', [tinyshar.Base64Encoder, tinyshar.RawEncoder])
+def test_adaptive(shar, run, somefiles, encoder, workers):
+    class CountingCompressor(tinyshar.XzCompressor):
+        def __init__(self):
+            super().__init__()
+            self.sizes = []
+
+        def wrap(self, reader):
+            def counting_reader(n):
+                chunk = reader(n)
+                self.sizes.append(len(chunk))
+                return chunk
+
+            return super().wrap(counting_reader)
+
+    inner = CountingCompressor()
+    compressor = tinyshar.AdaptiveCompressor(inner, sample_size=1000)
+    shar.add_file("random", os.urandom(100000))
+    shar.add_file("small", b"x" * 800)
+    shar.add_file("tiny", b"x" * 10)
+    shar.add_file("empty", b"")
+    shar.add_post("rm random small tiny empty")
+    run(encoder=encoder(compressor=compressor), workers=workers)
+    assert compressor.files_compressed == 2
+    assert compressor.files_skipped == 8
+    assert compressor.bytes_skipped == 100000 + 10 + 3 + 7 + 7 + 3 + 7
+    assert compressor.bytes_sampled == 2800
+    assert compressor.estimated_seconds_saved > 0
+    # samples of compressed files are not compressed twice
+    assert sum(inner.sizes) == 1000 + 800 + 1024 * 1024
+
+
+@pytest.mark.parametrize('size', [0, 10, 999, 1000, 1001, 5000])
+def test_adaptive_eof(size):
+    data = b"x" * size
+    stm = io.BytesIO(data)
+    eof = False
+
+    def reader(n):
+        nonlocal eof
+        assert not eof
+        chunk = stm.read(n)
+        eof = not chunk
+        return chunk
+
+    compressor = tinyshar.AdaptiveCompressor(tinyshar.XzCompressor(), sample_size=1000, min_size=100)
+    compressor_pipe_str, compressed_reader = compressor.wrap(reader)
+    compressed = b''.join(iter(lambda: bytes(compressed_reader(7)), b''))
+    assert (lzma.decompress(compressed) if compressor_pipe_str else compressed) == data
+    assert compressor.files_compressed == (size >= 100)
+
+
+def test_adaptive_no_samples():
+    assert tinyshar.AdaptiveCompressor(tinyshar.XzCompressor()).estimated_seconds_saved == 0.0
+
+
+def test_adaptive_bad_args():
+    with pytest.raises(ValueError):
+        tinyshar.AdaptiveCompressor(tinyshar.XzCompressor(), sample_size=10, min_size=100)
+
+
+@pytest.mark.parametrize('kw', [dict(threads=-1), dict(block_size=0), dict(threads='x'), dict(preset='x')])
+def test_xz_bad_args(kw):
+    with pytest.raises((ValueError, TypeError)):
+        tinyshar.XzCompressor(**kw)
+
+
+@pytest.mark.parametrize('size', [0, 1, 56, 57, 58, 57 * 1024, 57 * 1024 + 1, 200000])
+@pytest.mark.parametrize('short_reads', [False, True])
+def test_base64_body(size, short_reads):
+    data = os.urandom(size)
+    stm = io.BytesIO(data)
+
+    def reader(n):
+        return stm.read(n - 1 if short_reads and n > 1 else n)
+
+    chunks = []
+    tinyshar.Base64Encoder().encode(b"> x", reader, chunks.append, None)
+    assert b''.join(chunks) == b"base64 -d << '_END_' > x\n" + base64.encodebytes(data) + b"_END_\n"
+
+
+@pytest.mark.parametrize('read_size', [1, 57, 1000, 57 * 1024, 10 * 1024 * 1024])
+@pytest.mark.parametrize('threads', [1, 2])
+def test_xz_reader(read_size, threads):
+    data = os.urandom(100000) * 30
+    _, reader = tinyshar.XzCompressor(threads=threads, block_size=500000).wrap(io.BytesIO(data).read)
+    chunks = []
+
+    while True:
+        chunk = reader(read_size)
+        if not chunk:
+            break
+
+        assert len(chunk) <= read_size
+        chunks.append(bytes(chunk))
+
+    assert all(len(i) == read_size for i in chunks[:-1])
+    assert lzma.decompress(b''.join(chunks)) == data
+
+
+def test_xz_executor(shar, monkeypatch):
+    compressor = tinyshar.XzCompressor(threads=2, block_size=1000)
+
+    # input fitting into a single block is compressed without starting threads
+    _, reader = compressor.wrap(io.BytesIO(b"x" * 1000).read)
+    assert lzma.decompress(bytes(reader(1000000))) == b"x" * 1000
+    assert compressor._executor is None
+
+    executors = []
+    acquire_executor = compressor._acquire_executor
+
+    def recording_acquire_executor():
+        executors.append(acquire_executor())
+        return executors[-1]
+
+    monkeypatch.setattr(compressor, '_acquire_executor', recording_acquire_executor)
+
+    for i in range(10):
+        shar.add_file("f%d" % i, b"%d" % i * 10000)
+
+    for _ in range(2):
+        b''.join(shar.render(encoder=tinyshar.RawEncoder(compressor=compressor), workers=3))
+        # a single executor is shared by all files, and is shut down at the end of render
+        assert len(executors) == 10
+        assert all(i is executors[0] for i in executors)
+        assert compressor._executor is None
+        executors.clear()
+
+
+def test_xz_executor_in_use():
+    compressor = tinyshar.XzCompressor(threads=2)
+    executor = compressor._acquire_executor()
+
+    # e.g. a concurrent render has finished
+    compressor.close()
+    assert compressor._executor is executor
+    executor.submit(int).result()
+
+    compressor._release_executor()
+    compressor.close()
+    assert compressor._executor is None
+
+
+def test_xz_concurrent_renders(shar):
+    encoder = tinyshar.Base64Encoder(compressor=tinyshar.XzCompressor(threads=2, block_size=1000))
+    for i in range(20):
+        shar.add_file("f%d" % i, os.urandom(100) * (i * 10))
+
+    expected = b''.join(shar.render(encoder=encoder, build_validators=[]))
+    results = []
+
+    def render():
+        for _ in range(5):
+            results.append(b''.join(shar.render(encoder=encoder, build_validators=[], workers=2)))
+
+    threads = [threading.Thread(target=render) for _ in range(3)]
+    for i in threads:
+        i.start()
+
+    for i in threads:
+        i.join()
+
+    assert results == [expected] * 15
+
+
 def test_dup_file(shar):
     shar.add_file("one", '')
     with pytest.raises(FileExistsError):
@@ -241,6 +577,88 @@ def test_multiple_validators(shar):
         b''.join(shar.render(build_validators=[tinyshar.ShellcheckValidator(), tinyshar.ShellcheckValidator()]))
 
 
+def test_shellcheck_huge_output(shar):
+    # more than fits into a pipe buffer
+    for i in range(500):
+        shar.add_post('echo $x%d' % i)
+
+    with pytest.raises(tinyshar.ValidatorError) as e:
+        b''.join(shar.render())
+
+    assert len(e.value.args[1]) > 64 * 1024
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('encoder', [tinyshar.Base64Encoder(), tinyshar.RawEncoder()])
+def test_validator_skeleton(shar, encoder, workers):
+    skeleton = []
+
+    @contextlib.contextmanager
+    def validator():
+        yield skeleton.append
+
+    shar.add_file("empty", b"")
+    shar.add_file("big", b"x" * 1024 * 1024)
+    shar.add_file("small", b"y")
+    rendered = b''.join(shar.render(encoder=encoder, workers=workers, build_validators=[validator()]))
+    skeleton = b''.join(skeleton)
+
+    assert len(skeleton) < 10000
+    assert skeleton.count(b'# payload elided\n') == (0 if encoder.binary_payload else 2)
+    assert rendered.startswith(skeleton.replace(b'# payload elided\n', b'')[:100])
+
+
+@pytest.mark.parametrize('encoder', [tinyshar.Base64Encoder(), tinyshar.RawEncoder()])
+@pytest.mark.parametrize('extraction_verifiers', [
+    None,
+    [tinyshar.Md5Verifier(inline=True)],
+    [tinyshar.Sha256Verifier(jobs=2)],
+])
+def test_shellcheck_cache(shar, tmpdir, monkeypatch, encoder, extraction_verifiers):
+    cache_dir = tmpdir / "cache"
+    content = ["content"]
+    shar.add_file("f", lambda: content[0])
+    shar.add_file("g", lambda: content[0] * 2)
+    shar.add_file("h", "constant")
+
+    def render():
+        b''.join(shar.render(
+            build_validators=[tinyshar.ShellcheckValidator(cache_dir=str(cache_dir))],
+            extraction_verifiers=extraction_verifiers,
+            encoder=encoder
+        ))
+
+    render()
+    assert len(cache_dir.listdir()) == 1
+
+    # neither payload, nor its hashes or offsets, are a part of the skeleton
+    content[0] = "another, longer content"
+    with monkeypatch.context() as m:
+        m.setattr(tinyshar._subprocess, "Popen", None)
+        render()
+
+    shar.add_post("true")
+    render()
+    assert len(cache_dir.listdir()) == 2
+
+    shar.add_pre('"')
+    for _ in range(2):
+        with pytest.raises(tinyshar.ValidatorError):
+            render()
+
+    assert len(cache_dir.listdir()) == 2
+
+
+def test_shellcheck_cache_trim(shar, tmpdir):
+    cache_dir = tmpdir / "cache"
+
+    for i in range(3):
+        shar.add_post("true")
+        b''.join(shar.render(build_validators=[tinyshar.ShellcheckValidator(cache_dir=str(cache_dir), cache_size=14)]))
+
+    assert len(cache_dir.listdir()) == 2
+
+
 def test_no_shellcheck(shar):
     shar.add_pre('"')
     b''.join(shar.render(build_validators=[]))
@@ -261,6 +679,181 @@ def test_run_retcode(shar, run, stage, cmd, expect_returncode, tee_to_file):
     run(expect_returncode=[expect_returncode], tee_to_file=tee_to_file)
 
 
+@pytest.mark.parametrize('trace', ['full', 'user'])
+@pytest.mark.parametrize('tee_to_file', [False, True])
+def test_trace(shar, run, trace, tee_to_file):
+    shar.add_pre("echo pre")
+    shar.add_post("echo post")
+    shar.add_file("one", "1")
+    run(trace=trace, tee_to_file=tee_to_file)
+
+    # with tee_to_file, traces are redirected to stdout
+    output = run.stdout if tee_to_file else run.stderr
+    assert b"+ echo pre\n" in output
+    assert b"+ echo post\n" in output
+    assert (b"md5sum -c" in output) == (trace == 'full')
+    assert (b"+ mkdir arena\n" in output) == (trace == 'full')
+
+
+def test_trace_bad(shar):
+    with pytest.raises(ValueError):
+        shar.render(trace='none')
+
+
+@pytest.mark.parametrize('tee_to_file', [False, True])
+def test_raw_truncated(shar, run, tee_to_file):
+    shar.add_file("one", b"one")
+    run(
+        expect_returncode=[1],
+        encoder=tinyshar.RawEncoder(compressor=tinyshar.XzCompressor()),
+        patch_cb=lambda s: s[:-1],
+        tee_to_file=tee_to_file
+    )
+
+
+@pytest.mark.parametrize('sendfile', ['works', 'fails', 'missing'])
+def test_raw_large_payload(shar, run, monkeypatch, sendfile):
+    # large enough for the payload to be spooled to a temporary file
+    data = os.urandom(17 * 1024 * 1024)
+    shar.add_file("big", data)
+
+    if sendfile == 'fails':
+        def failing_sendfile(*args):
+            raise OSError(errno.EINVAL, "not supported")
+
+        monkeypatch.setattr(tinyshar._os, 'sendfile', failing_sendfile)
+    elif sendfile == 'missing':
+        monkeypatch.delattr(tinyshar._os, 'sendfile')
+
+    def check(**kw):
+        assert (run.arena_dir / "big").read_binary() == data
+
+    run.add_post(check)
+    shar.add_post("false")
+    run(expect_returncode=[1], encoder=tinyshar.RawEncoder())
+
+
+def test_raw_cdpath(shar, tmpdir, run_wrapper):
+    shar.add_file("f", b"hello")
+    shar.add_post('test "$(cat f)" = hello')
+
+    script = tmpdir / "a" / "script.sh"
+    script.write_binary(b''.join(shar.render(encoder=tinyshar.RawEncoder())), ensure=True)
+    os.chmod(str(script), 0o500)
+
+    # a relative cd must neither land in the decoy nor print anything
+    (tmpdir / "decoy" / "a").ensure(dir=True)
+    env = dict(os.environ, CDPATH=str(tmpdir / "decoy"))
+    cp = subprocess.run(
+        run_wrapper + [os.path.join("a", "script.sh")],
+        cwd=str(tmpdir),
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    assert cp.returncode == 0, cp.stderr
+
+
+def test_spool_send_to():
+    spool = tinyshar._Spool()
+    spool._MAX_MEMORY_SIZE = 10
+    spool.write(b"01234")
+    spool.write(b"56789abc")
+    out_stm = io.BytesIO()
+    spool.send_to(out_stm)
+    spool.close()
+    assert out_stm.getvalue() == b"0123456789abc"
+
+
+@pytest.mark.parametrize('kind', ['buffered', 'unbuffered', 'gzip', 'lzma'])
+def test_spool_send_to_file(tmpdir, monkeypatch, kind):
+    spool = tinyshar._Spool()
+    spool._MAX_MEMORY_SIZE = 10
+    spool.write(b"01234")
+    spool.write(b"56789abc")
+
+    calls = []
+    sendfile = os.sendfile
+
+    def recording_sendfile(*args):
+        calls.append(args)
+        return sendfile(*args)
+
+    monkeypatch.setattr(tinyshar._os, 'sendfile', recording_sendfile)
+
+    path = str(tmpdir / "out")
+    module = dict(buffered=io, unbuffered=io, gzip=gzip, lzma=lzma)[kind]
+    kw = dict(buffering=0) if kind == 'unbuffered' else {}
+
+    with module.open(path, 'wb', **kw) as stm:
+        stm.write(b"head")
+        spool.send_to(stm)
+        stm.write(b"tail")
+
+    spool.close()
+
+    with module.open(path, 'rb') as stm:
+        assert stm.read() == b"head0123456789abctail"
+
+    # data must not bypass compression of e.g. gzip.GzipFile, which also has fileno()
+    assert bool(calls) == (module is io)
+
+
+@pytest.mark.parametrize('mmap_min_size', [0, 4, 1024 * 1024])
+def test_open_source(tmpdir, monkeypatch, mmap_min_size):
+    monkeypatch.setattr(tinyshar, '_MMAP_MIN_SIZE', mmap_min_size)
+
+    def read_all(what):
+        with tinyshar._open_source(what, mmap=True) as reader:
+            return b''.join(bytes(i) for i in iter(lambda: reader(3), b''))
+
+    path = tmpdir / "f"
+    path.write_binary(b"0123456789")
+    assert read_all(lambda: open(str(path), 'rb')) == b"0123456789"
+
+    stm = open(str(path), 'rb')
+    stm.read(4)
+    assert read_all(stm) == b"456789"
+
+    empty_path = tmpdir / "empty"
+    empty_path.write_binary(b"")
+    assert read_all(lambda: open(str(empty_path), 'rb')) == b""
+
+    r, w = os.pipe()
+    os.write(w, b"pipe")
+    os.close(w)
+    assert read_all(os.fdopen(r, 'rb')) == b"pipe"
+
+    assert read_all(io.BytesIO(b"bytes")) == b"bytes"
+
+    # a slice outliving the reader keeps the mapping alive
+    with tinyshar._open_source(open(str(path), 'rb'), mmap=True) as reader:
+        chunk = reader(4)
+
+    assert chunk == b"0123"
+
+
+@pytest.mark.parametrize('mmap_min_size', [0, 1024 * 1024])
+def test_open_source_rewind(tmpdir, monkeypatch, mmap_min_size):
+    monkeypatch.setattr(tinyshar, '_MMAP_MIN_SIZE', mmap_min_size)
+
+    path = tmpdir / "f"
+    path.write_binary(b"0123456789")
+
+    for what in [open(str(path), 'rb'), io.BytesIO(b"0123456789")]:
+        what.read(4)
+        with tinyshar._open_source(what, mmap=True) as reader:
+            assert bytes(reader(100)) == b"456789"
+            reader.rewind()
+            assert bytes(reader(100)) == b"456789"
+
+    r, w = os.pipe()
+    os.close(w)
+    with tinyshar._open_source(os.fdopen(r, 'rb'), mmap=True) as reader:
+        assert reader.rewind is None
+
+
 @pytest.mark.parametrize('tee_to_file', [False, True])
 def test_bad_md5(shar, run, tee_to_file):
     shar.add_file("one", "")
@@ -276,11 +869,330 @@ def test_dirs1(shar, run, somefiles):
     run(expect_returncode=[1])
 
 
-@pytest.mark.parametrize('encoder', [None, tinyshar.Base64Encoder()])
+@pytest.mark.parametrize('kw', [dict(), dict(dedup=True, workers=2)])
+def test_mmap(shar, run, somefiles, kw):
+    run(mmap=True, **kw)
+
+
+def test_no_mmap_by_default(shar, tmpdir, monkeypatch):
+    path = tmpdir / "big"
+    path.write_binary(b"x" * (2 * 1024 * 1024))
+    shar.add_file("big", lambda: open(str(path), 'rb'))
+
+    def fail(*a):
+        assert False  # pragma: no cover
+
+    # a mapped file truncated meanwhile would crash the process
+    monkeypatch.setattr(tinyshar, '_mmap_stm', fail)
+    b''.join(shar.render(build_validators=[]))
+
+
+@pytest.mark.parametrize('encoder', [
+    None,
+    tinyshar.Base64Encoder(),
+    tinyshar.RawEncoder(),
+    tinyshar.RawEncoder(compressor=tinyshar.XzCompressor()),
+    tinyshar.Base64Encoder(compressor=tinyshar.XzCompressor(threads=3, block_size=100000)),
+    tinyshar.RawEncoder(compressor=tinyshar.XzCompressor(threads=0, preset=1)),
+    tinyshar.Base64Encoder(compressor=tinyshar.GzipCompressor()),
+    tinyshar.RawEncoder(compressor=tinyshar.GzipCompressor(level=1)),
+])
 def test_dirs2(shar, run, somefiles, encoder):
     run(encoder=encoder)
 
 
+@pytest.mark.parametrize('encoder', [None, tinyshar.RawEncoder()])
+def test_dirs_workers(shar, run, somefiles, encoder):
+    run(encoder=encoder, workers=3)
+
+
+@pytest.mark.parametrize('encoder', [tinyshar.Base64Encoder(), tinyshar.RawEncoder()])
+def test_workers_deterministic(shar, encoder):
+    for i in range(20):
+        shar.add_file("d%d/f%d" % (i % 3, i), b"%d" % i * (i * 1000))
+
+    rendered1 = b''.join(shar.render(encoder=encoder))
+    rendered2 = b''.join(shar.render(encoder=encoder, workers=4))
+    assert rendered1 == rendered2
+
+
+def test_workers_error(shar):
+    for i in range(20):
+        shar.add_file("f%d" % i, "" if i != 5 else 1)
+
+    with pytest.raises(TypeError):
+        shar.render(workers=2)
+
+
+@pytest.mark.parametrize('workers', [0, 'x'])
+def test_workers_bad(shar, workers):
+    with pytest.raises((ValueError, TypeError)):
+        shar.render(workers=workers)
+
+
+@pytest.mark.parametrize('encoder', [None, tinyshar.RawEncoder()])
+def test_dirs_solid(shar, run, somefiles, encoder):
+    run(encoder=encoder, solid=True)
+
+
+def test_solid_empty(shar, run):
+    run(solid=True)
+
+
+def test_solid_bad_md5(shar, run):
+    shar.add_file("one", "")
+    run(
+        expect_returncode=[1],
+        solid=True,
+        patch_cb=lambda s: s.replace(b'd41d8cd98f00b204e9800998ecf8427e', b'deadbeaf'),
+    )
+
+
+@pytest.mark.parametrize('solid', [False, True])
+def test_special_names(shar, run, solid):
+    names = ["back\\slash", "new\nline", "sp ace", "'quote'"]
+    for i in names:
+        shar.add_file("d/" + i, i)
+
+    def check(**kw):
+        for i in names:
+            assert (run.arena_dir / "d" / i).read_text("utf-8") == i
+
+    run.add_post(check)
+    shar.add_post("false")
+    run(expect_returncode=[1], solid=solid)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+@pytest.mark.parametrize('encoder', [None, tinyshar.RawEncoder()])
+def test_dedup(shar, run, encoder, workers):
+    for i in range(10):
+        shar.add_file("dup/%d" % i, b"dup" * 1000 * (i % 3))
+
+    def check(**kw):
+        for i in range(10):
+            assert (run.arena_dir / "dup" / str(i)).read_binary() == b"dup" * 1000 * (i % 3)
+
+    run.add_post(check)
+    shar.add_post("false")
+    run(expect_returncode=[1], encoder=encoder, dedup=True, workers=workers)
+
+
+@pytest.mark.parametrize('encoder', [tinyshar.Base64Encoder(), tinyshar.RawEncoder()])
+def test_dedup_deterministic(shar, encoder):
+    for i in range(30):
+        shar.add_file("f%d" % i, b"%d" % (i % 4) * 1000)
+
+    rendered1 = b''.join(shar.render(encoder=encoder, dedup=True))
+    rendered2 = b''.join(shar.render(encoder=encoder, dedup=True, workers=4))
+    assert rendered1 == rendered2
+    assert rendered1.count(b'\ncp ') == 26
+    assert len(rendered1) < len(b''.join(shar.render(encoder=encoder)))
+
+
+@pytest.mark.parametrize('kw', [dict(dedup=True), dict(cache=tinyshar.PayloadCache)])
+def test_solid_dedup(shar, tmpdir, kw):
+    if 'cache' in kw:
+        kw['cache'] = kw['cache'](str(tmpdir / "cache"))
+
+    with pytest.raises(ValueError):
+        shar.render(solid=True, **kw)
+
+
+@pytest.mark.parametrize('encoder', [None, tinyshar.RawEncoder()])
+def test_cache_run(shar, run, somefiles, tmpdir, encoder):
+    cache = tinyshar.PayloadCache(str(tmpdir / "cache"))
+    b''.join(shar.render(encoder=encoder, cache=cache, build_validators=[]))
+    run(encoder=encoder, cache=cache, workers=2)
+
+
+@pytest.mark.parametrize('encoder', [
+    tinyshar.Base64Encoder(),
+    tinyshar.Base64Encoder(compressor=tinyshar.XzCompressor()),
+    tinyshar.RawEncoder(compressor=tinyshar.XzCompressor(threads=2)),
+])
+@pytest.mark.parametrize('workers', [1, 3])
+def test_cache(shar, tmpdir, monkeypatch, encoder, workers):
+    cache_dir = tmpdir / "cache"
+    for i in range(10):
+        shar.add_file("f%d" % i, b"%d" % i * 1000)
+
+    expected = b''.join(shar.render(encoder=encoder))
+
+    cache = tinyshar.PayloadCache(str(cache_dir))
+    assert b''.join(shar.render(encoder=encoder, cache=cache, workers=workers)) == expected
+    assert len(cache_dir.listdir()) == 10
+
+    def fail(*a):
+        assert False  # pragma: no cover
+
+    monkeypatch.setattr(encoder, 'prepare', fail)
+    # content of cached files is not spooled
+    monkeypatch.setattr(tinyshar._Spool, 'append', fail)
+    assert b''.join(shar.render(encoder=encoder, cache=cache, workers=workers, dedup=True)) == expected
+
+
+def zstd_compressor(**kw):
+    pytest.importorskip('zstandard')
+    return tinyshar.ZstdCompressor(**kw)
+
+
+def adaptive_compressor(level=6, **kw):
+    return tinyshar.AdaptiveCompressor(tinyshar.GzipCompressor(level=level), **kw)
+
+
+@pytest.mark.parametrize('make_compressor, variants', [
+    (tinyshar.GzipCompressor, [dict(level=1), dict(level=9)]),
+    (adaptive_compressor, [dict(level=1), dict(sample_size=1000), dict(max_ratio=0.5), dict(min_size=100)]),
+    (zstd_compressor, [dict(level=1), dict(threads=2)]),
+])
+def test_cache_key(shar, tmpdir, monkeypatch, make_compressor, variants):
+    cache_dir = tmpdir / "cache"
+    cache = tinyshar.PayloadCache(str(cache_dir))
+    shar.add_file("f", b"0123456789" * 1000)
+
+    def render(encoder):
+        b''.join(shar.render(encoder=encoder, cache=cache))
+        return len(cache_dir.listdir())
+
+    assert render(tinyshar.RawEncoder(compressor=make_compressor())) == 1
+
+    def fail(*a):
+        assert False  # pragma: no cover
+
+    # equal settings hit the entry
+    encoder = tinyshar.RawEncoder(compressor=make_compressor())
+    monkeypatch.setattr(encoder, 'prepare', fail)
+    assert render(encoder) == 1
+
+    # any different setting misses it
+    for n, kw in enumerate(variants, 2):
+        assert render(tinyshar.RawEncoder(compressor=make_compressor(**kw))) == n
+
+
+def test_cache_unseekable(shar, tmpdir, monkeypatch):
+    cache = tinyshar.PayloadCache(str(tmpdir / "cache"))
+
+    def pipe():
+        r, w = os.pipe()
+        os.write(w, b"pipe")
+        os.close(w)
+        return os.fdopen(r, 'rb')
+
+    shar.add_file("f", pipe)
+    encoder = tinyshar.Base64Encoder()
+    expected = b''.join(shar.render(encoder=encoder, cache=cache))
+
+    def fail(*a):
+        assert False  # pragma: no cover
+
+    monkeypatch.setattr(encoder, 'prepare', fail)
+    assert b''.join(shar.render(encoder=encoder, cache=cache)) == expected
+
+
+def test_cache_trim(shar, tmpdir):
+    cache_dir = tmpdir / "cache"
+    cache = tinyshar.PayloadCache(str(cache_dir), max_size=2500)
+    for i in range(10):
+        shar.add_file("f%d" % i, b"%d" % i * 1000)
+
+    b''.join(shar.render(encoder=tinyshar.RawEncoder(), cache=cache))
+    assert len(cache_dir.listdir()) == 2
+
+
+def test_dir_cache_trim(tmpdir):
+    cache_dir = tmpdir / "cache"
+    cache = tinyshar._DirCache(str(cache_dir), 250)
+
+    for i in range(5):
+        cache.store("e%d" % i, [b"x" * 100])
+        os.utime(str(cache_dir / ("e%d" % i)), (1000 + i, 1000 + i))
+
+    # a temporary file of an unfinished store and a directory are neither counted nor evicted
+    (cache_dir / ".tmpfoo").write_binary(b"x" * 1000)
+    (cache_dir / "subdir").mkdir()
+
+    # opening an entry makes it the most recently used one
+    cache.open("e0").close()
+
+    cache.trim()
+    assert sorted(i.basename for i in cache_dir.listdir()) == [".tmpfoo", "e0", "e4", "subdir"]
+
+
+def test_cache_store_error(shar, tmpdir):
+    cache_dir = tmpdir / "cache"
+    cache = tinyshar.PayloadCache(str(cache_dir))
+
+    class Error(Exception):
+        pass
+
+    class Encoder(tinyshar.RawEncoder):
+        def prepare(self, reader, probe=None):
+            compressor_pipe_str, spool = super().prepare(reader, probe)
+            chunks = spool.chunks
+
+            def failing_chunks():
+                # fail in the middle of writing a cache entry
+                yield from chunks()
+                raise Error()
+
+            spool.chunks = failing_chunks
+            return compressor_pipe_str, spool
+
+    shar.add_file("f", "data")
+    with pytest.raises(Error):
+        shar.render(encoder=Encoder(), cache=cache)
+
+    assert cache_dir.listdir() == []
+
+
+@pytest.mark.parametrize('dedup', [False, True])
+@pytest.mark.parametrize('encoder', [tinyshar.Base64Encoder(), tinyshar.RawEncoder(compressor=tinyshar.XzCompressor())])
+@pytest.mark.parametrize('extract_jobs', [2, 5])
+def test_extract_jobs(shar, run, encoder, dedup, extract_jobs):
+    for i in range(10):
+        shar.add_file("many/%d" % i, "%d" % (i % 3) * 100000)
+
+    def check(**kw):
+        for i in range(10):
+            assert (run.arena_dir / "many" / str(i)).read_text("utf-8") == "%d" % (i % 3) * 100000
+
+    run.add_post(check)
+    shar.add_post("false")
+    run(expect_returncode=[1], encoder=encoder, dedup=dedup, extract_jobs=extract_jobs)
+
+
+def test_extract_jobs_failure(shar, run):
+    for i in range(10):
+        shar.add_file("f%d" % i, "%d" % i)
+
+    # the failing job is neither the first nor the last one to be waited for
+    run(
+        expect_returncode=[1],
+        extract_jobs=3,
+        extraction_verifiers=[],
+        patch_cb=lambda s: s.replace(b"> '000004'", b"| false > '000004'"),
+    )
+
+
+def test_extract_jobs_portable(shar):
+    shar.add_file("one", "1")
+    rendered = b''.join(shar.render(extract_jobs=2))
+    # `wait -n` is not available in bash < 4.3 and other shells
+    assert b"wait -n" not in rendered
+
+
+@pytest.mark.parametrize('kw', [dict(extract_jobs=0), dict(extract_jobs='x'), dict(extract_jobs=2, solid=True)])
+def test_extract_jobs_bad(shar, kw):
+    with pytest.raises((TypeError, ValueError)):
+        shar.render(**kw)
+
+
+def test_solid_workers(shar):
+    with pytest.raises(ValueError):
+        shar.render(solid=True, workers=2)
+
+
 def test_dirs3(shar, run, somefiles):
     shar.add_pre("false")
     run(expect_returncode=[1], cb_params=dict(expect_files=False))
@@ -304,6 +1216,101 @@ def test_dirs_tags_cb(shar, run, somefiles):
     assert len(shar.files_by_tag("tag1")) == 1
 
 
+@pytest.mark.parametrize('add_dir_kw, kw', [
+    (dict(scan_workers=3), dict()),
+    (dict(lazy=True), dict()),
+    (dict(lazy=True, scan_workers=3), dict(workers=2)),
+    (dict(lazy=True), dict(solid=True)),
+    (dict(lazy=True), dict(dedup=True, extract_jobs=2)),
+    (dict(lazy=True), dict(batch_moves=True, workers=2)),
+    (dict(lazy=True), dict(extract_in_place=True, dedup=True)),
+])
+def test_dirs_scan(shar, run, somefiles, add_dir_kw, kw):
+    run(cb_params=dict(add_dir_kw=add_dir_kw), **kw)
+
+
+@pytest.mark.parametrize('scan_workers', [1, 4])
+def test_dirs_scan_order(shar, tmpdir, scan_workers):
+    for i in range(30):
+        (tmpdir / "d{}".format(i % 7) / "e{}".format(i % 3) / "f{}".format(i)).write_binary(b"", ensure=True)
+
+    names = []
+    shar.add_dir(str(tmpdir), '', tags_cb=lambda e: names.append(e.name) or [], scan_workers=scan_workers)
+    assert names == [
+        "f{}".format(i) for i in sorted(range(30), key=lambda i: ("d{}".format(i % 7), "e{}".format(i % 3), str(i)))
+    ]
+    assert len(shar._files) == 30
+
+
+@pytest.mark.parametrize('scan_workers', [1, 3])
+def test_dirs_scan_bad_entry(shar, tmpdir, scan_workers):
+    (tmpdir / "d" / "f").write_binary(b"", ensure=True)
+    os.mkfifo(str(tmpdir / "d" / "fifo"))
+
+    with pytest.raises(ValueError, match="fifo"):
+        shar.add_dir(str(tmpdir), '', scan_workers=scan_workers)
+
+    shar.add_dir(str(tmpdir), 'lazy', scan_workers=scan_workers, lazy=True)
+    with pytest.raises(ValueError, match="fifo"):
+        shar.render()
+
+
+def test_dirs_lazy(shar, tmpdir):
+    d = tmpdir / "src"
+    (d / "a" / "f").write_binary(b"", ensure=True)
+    shar.add_dir(str(d), 'x', lazy=True)
+    assert shar._files == {}
+
+    # the directory is scanned by each render
+    rendered = b''.join(shar.render(build_validators=[]))
+    assert b'# file: x/a/f\n' in rendered
+    assert b'# file: x/a/g\n' not in rendered
+
+    (d / "a" / "g").write_binary(b"", ensure=True)
+    rendered = b''.join(shar.render(build_validators=[]))
+    assert b'# file: x/a/g\n' in rendered
+    assert b"mkdir -p x/a\n" in rendered
+
+
+def test_dirs_lazy_empty(shar, run, tmpdir):
+    (tmpdir / "empty").mkdir()
+    shar.add_dir(str(tmpdir / "empty"), '', lazy=True)
+    run()
+
+
+@pytest.mark.parametrize('name, exc', [
+    ("x/a", FileExistsError),
+    ("x/a/f/g", IsADirectoryError),
+    ("x/a/f", FileExistsError),
+])
+def test_dirs_lazy_conflict(shar, tmpdir, name, exc):
+    (tmpdir / "a" / "f").write_binary(b"", ensure=True)
+    shar.add_file(name, "")
+    shar.add_dir(str(tmpdir), 'x', lazy=True)
+
+    with pytest.raises(exc):
+        shar.render(build_validators=[])
+
+
+def test_dirs_lazy_conflict_lazy(shar, tmpdir):
+    (tmpdir / "a" / "f").write_binary(b"", ensure=True)
+    shar.add_dir(str(tmpdir), 'x', lazy=True)
+    shar.add_dir(str(tmpdir / "a"), 'x/a', lazy=True)
+
+    with pytest.raises(FileExistsError):
+        shar.render(build_validators=[])
+
+
+@pytest.mark.parametrize('kw', [
+    dict(lazy=True, tags_cb=lambda e: []),
+    dict(scan_workers=0),
+    dict(scan_workers='x'),
+])
+def test_dirs_scan_bad(shar, tmpdir, kw):
+    with pytest.raises((ValueError, TypeError)):
+        shar.add_dir(str(tmpdir), '', **kw)
+
+
 def test_chunk_order(shar):
     shar.add_pre("f", order=3)
     shar.add_pre("e", order=3)
@@ -329,6 +1336,70 @@ def test_target_is_a_dir(tmpdir, shar, run):
     run(expect_returncode=[1])
 
 
+def test_batch_moves_target_is_a_dir(tmpdir, shar, run):
+    d = tmpdir / "target"
+    d.mkdir()
+    shar.add_file(str(d), "")
+    # nothing is moved unless all targets are checked
+    shar.add_file(str(tmpdir / "other" / "f"), "")
+    shar.add_file(str(tmpdir / "z" / "f"), "")
+    run(expect_returncode=[1], batch_moves=True)
+    assert not (tmpdir / "other" / "f").exists()
+    assert not (tmpdir / "z" / "f").exists()
+
+
+@pytest.mark.parametrize('kw', [
+    dict(),
+    dict(encoder=tinyshar.RawEncoder(), workers=2, dedup=True),
+    dict(solid=True),
+    dict(extract_jobs=2, dedup=True),
+    dict(extract_in_place=True),
+])
+def test_batch_moves(tmpdir, shar, run, somefiles, kw):
+    target = tmpdir / "existing" / "it's \"quoted\"\n"
+    target.write_binary(b"old", ensure=True)
+    shar.add_file(str(target), "new")
+    shar.add_file(str(tmpdir / "existing" / "-dash"), "dash")
+    shar.add_file("top", "")
+    run(batch_moves=True, **kw)
+    assert target.read_binary() == b"new"
+    assert (tmpdir / "existing" / "-dash").read_binary() == b"dash"
+
+    rendered = b''.join(shar.render(batch_moves=True, build_validators=[], **kw))
+    assert b"\nmv -f " not in rendered
+    assert b"-exec sh -c 'for f; do test ! -d" in rendered
+
+
+@pytest.mark.parametrize('kw', [
+    dict(),
+    dict(encoder=tinyshar.RawEncoder(), workers=2, dedup=True),
+    dict(solid=True),
+    dict(extract_jobs=2, dedup=True),
+])
+def test_extract_in_place(tmpdir, shar, run, kw):
+    for i in range(100):
+        shar.add_file("many/d%d/f" % i, "%d" % i)
+
+    for i in range(3):
+        shar.add_file(str(tmpdir / "abs" / str(i)), "abs%d" % i)
+
+    def check(**kw):
+        for i in range(100):
+            assert (run.arena_dir / "many" / ("d%d" % i) / "f").read_text("utf-8") == "%d" % i
+
+        for i in range(3):
+            assert (tmpdir / "abs" / str(i)).read_text("utf-8") == "abs%d" % i
+
+    run.add_post(check)
+    shar.add_post("false")
+    run(extract_in_place=True, expect_returncode=[1], **kw)
+
+    rendered = b''.join(shar.render(extract_in_place=True, build_validators=[], **kw))
+    # only files with absolute names are moved
+    assert rendered.count(b"\nmv -f ") == 3
+    assert rendered.count(b"\nmkdir -p 'arena/") == (0 if kw.get('solid') else 2)
+
+
 def test_file_vs_dir(shar):
     shar.add_file("a/b", "")
     with pytest.raises(IsADirectoryError):
@@ -339,3 +1410,153 @@ def test_dir_vs_file(shar):
     shar.add_file("a", "")
     with pytest.raises(FileExistsError):
         shar.add_file("a/b", "")
+
+
+def test_path_tree():
+    tree = tinyshar._PathTree()
+    for name in ["f", "a/b/c/f", "a/b/f", "a/b-c/f", "a/b/d/f", "/f", "/x/f", "/x/y/f", "a/b-c/g/f"]:
+        tree.add_file(name.split('/'))
+
+    assert list(tree.leaf_dirs()) == [
+        ('', 'x', 'y'),
+        ('a', 'b', 'c'),
+        ('a', 'b', 'd'),
+        ('a', 'b-c', 'g'),
+    ]
+
+    for name, exc, conflict in [
+        ("a/b/f/g/h", FileExistsError, "a/b/f"),
+        ("/x/f", FileExistsError, "/x/f"),
+        ("a/b", IsADirectoryError, "a/b"),
+    ]:
+        with pytest.raises(exc, match="^%s$" % conflict):
+            tree.add_file(name.split('/'))
+
+    # failed additions leave the tree intact
+    assert ('a', 'b', 'f', 'g') not in list(tree.leaf_dirs())
+
+
+@pytest.mark.parametrize('kw, phases', [
+    (dict(), {'read', 'verify', 'compress', 'encode', 'write'}),
+    (dict(workers=2), {'read', 'verify', 'compress', 'encode', 'write'}),
+    (dict(dedup=True), {'read', 'verify', 'spool', 'compress', 'encode', 'write'}),
+    (dict(dedup=True, workers=2), {'read', 'verify', 'spool', 'compress', 'encode', 'write'}),
+    (dict(encoder=tinyshar.RawEncoder()), {'read', 'verify', 'compress', 'encode', 'write'}),
+])
+def test_stats(shar, run, somefiles, kw, phases):
+    shar.add_file("dup1", b"dup" * 1000)
+    shar.add_file("dup2", b"dup" * 1000)
+    stats = tinyshar.RenderStats()
+    run(stats=stats, **kw)
+
+    assert set(stats.phases) == phases
+    assert set(stats.render_seconds) == {'validate', 'total'}
+    assert len(stats.files) == 8
+    assert stats.files["d2/3"]["read"][:2] == [1024 * 1024, 1024 * 1024]
+    bytes_in, bytes_out, _ = stats.files["d2/3"]["compress"]
+    assert bytes_in == 1024 * 1024
+    # default encoder compresses with xz
+    assert (bytes_out == bytes_in) if kw.get('encoder') else (bytes_out < 1000)
+    assert stats.phases["read"][:3] == [8, 1024 * 1024 + 6027, 1024 * 1024 + 6027]
+
+    if kw.get('dedup'):
+        assert 'encode' not in stats.files["dup2"]
+    else:
+        bytes_in, bytes_out, _ = stats.files["dup2"]["encode"]
+        assert bytes_in == stats.files["dup2"]["compress"][1]
+        assert bytes_out > bytes_in
+
+    summary = stats.summary(slowest=3)
+    assert summary.count('\n') == 1 + len(phases) + 2 + 2 + 3
+    assert 'slowest files:' in summary
+
+
+def test_stats_solid(shar):
+    shar.add_file("a", "a" * 1000)
+    shar.add_file("/b", "b")
+    stats = tinyshar.RenderStats()
+    b''.join(shar.render(solid=True, stats=stats, build_validators=[]))
+
+    assert set(stats.files) == {'a', '/b', '<solid>'}
+    assert set(stats.files['a']) == {'read', 'verify', 'spool'}
+    assert set(stats.files['<solid>']) == {'spool', 'compress', 'encode', 'write'}
+    assert stats.files['<solid>']['compress'][0] == 3 * 512 + 1024 + 2 * 512
+    assert set(stats.render_seconds) == {'total'}
+
+
+def test_stats_empty(shar):
+    stats = tinyshar.RenderStats()
+    b''.join(shar.render(stats=stats))
+
+    assert stats.files == {}
+    assert 'slowest files:' not in stats.summary()
+
+
+def test_stats_error(shar):
+    shar.add_file("a", 1)
+    stats = tinyshar.RenderStats()
+
+    with pytest.raises(TypeError):
+        shar.render(stats=stats)
+
+    assert set(stats.render_seconds) == {'validate', 'total'}
+
+
+@pytest.mark.parametrize('kw', [
+    dict(),
+    dict(chunk_size=1000, max_memory=3000),
+    dict(chunk_size=1000, max_memory=1, spill=True),
+])
+@pytest.mark.parametrize('encoder', [tinyshar.Base64Encoder(), tinyshar.RawEncoder()])
+def test_render_iter(shar, encoder, kw):
+    for i in range(100):
+        shar.add_file("f%d" % i, os.urandom(i * 100))
+
+    chunks = list(shar.render_iter(encoder=encoder, **kw))
+    assert b''.join(chunks) == b''.join(shar.render(encoder=encoder))
+    assert all(len(i) >= kw.get('chunk_size', 1024 * 1024) for i in chunks[:-1])
+
+
+def test_render_iter_slow_consumer(shar, monkeypatch):
+    for i in range(100):
+        shar.add_file("f%d" % i, os.urandom(1000))
+
+    expected = b''.join(shar.render(encoder=tinyshar.Base64Encoder()))
+    channels = []
+    get = tinyshar._Channel.get
+
+    def slow_get(self):
+        # the consumer does not get anything until rendering has finished
+        with self._cond:
+            while not self._done:
+                self._cond.wait()
+
+        channels.append(self)
+        return get(self)
+
+    monkeypatch.setattr(tinyshar._Channel, 'get', slow_get)
+    chunks = list(shar.render_iter(encoder=tinyshar.Base64Encoder(), chunk_size=1000, max_memory=1, spill=True))
+    assert b''.join(chunks) == expected
+    # everything but the first chunk has been spilled to a temporary file
+    assert len(chunks) > 2
+    assert channels[0]._spill_size == sum(len(i) for i in chunks[1:])
+
+
+@pytest.mark.parametrize('spill', [False, True])
+def test_render_iter_close(shar, spill):
+    for i in range(100):
+        shar.add_file("f%d" % i, os.urandom(1000))
+
+    it = shar.render_iter(chunk_size=1000, max_memory=1000, spill=spill, build_validators=[])
+    next(it)
+    it.close()
+
+
+def test_render_iter_errors(shar):
+    shar.add_file("f", 1)
+
+    with pytest.raises(TypeError):
+        list(shar.render_iter())
+
+    with pytest.raises(TypeError):
+        list(shar.render_iter(out_stm=io.BytesIO()))